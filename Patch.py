@@ -1,8 +1,9 @@
 #!/usr/bin/python
 
-import bisect
 import difflib
-import networkx as nx
+import random
+import numpy as np
+from csrGraph import GraphBuilder
 
 # Models individual insertions and deletions as Patches, revisions as
 #   PatchSets, and the history of ownership of text as a PatchModel
@@ -50,10 +51,12 @@ class PatchSet:
         self.patches = []
 
     @classmethod
-    def psdiff(cls, startid, old, new):
+    def psdiff(cls, startid, old, new, engine='matcher'):
         """
             Compares 2 vesions of text at a word level to identify 
                 the individual edits (insertions and deletions).
+            engine names the diff engine in ENGINES that computes the edit
+                script.
         """
         ptype = None
         ps = cls()
@@ -61,12 +64,12 @@ class PatchSet:
         pid = startid
 
         # Obtain a list of differences between the texts
-        diff = difflib.ndiff(old, new)
+        diff = ENGINES[engine](old, new)
         
         # Split the differences into Patches
         index = 0
-        for line in diff:
-            if line[0] == ' ':
+        for (op, n) in diff:
+            if op == ' ':
                 # If equal, terminate any current patch.
                 if ptype is not None:
                     ps.append_patch(Patch(pid, ptype, start, index))
@@ -74,8 +77,8 @@ class PatchSet:
                     if ptype == PatchType.DELETE:
                         index = start
                     ptype = None
-                index += 1
-            elif line[0] == '+':
+                index += n
+            elif op == '+':
                 # If addition, terminate any current DELETE patch.
                 if ptype == PatchType.DELETE:
                     ps.append_patch(Patch(pid, ptype, start, index))
@@ -86,8 +89,8 @@ class PatchSet:
                 if ptype is None:
                     ptype = PatchType.ADD
                     start = index
-                index += 1
-            elif line[0] == '-':
+                index += n
+            elif op == '-':
                 # If deletion, terminate any current ADD patch.
                 if ptype == PatchType.ADD:
                     ps.append_patch(Patch(pid, ptype, start, index))
@@ -97,8 +100,7 @@ class PatchSet:
                 if ptype is None:
                     ptype = PatchType.DELETE
                     start = index
-                index += 1
-            # Skip line[0] == '?' completely.
+                index += n
 
         # Terminate and add any remaining patch.
         if ptype is not None:
@@ -111,30 +113,779 @@ class PatchSet:
 
 
 
+# Diff engines compare 2 lists of words and yield the edit script as runs of
+#   (op, count), where op is ' ' (kept), '+' (added) or '-' (deleted), in the
+#   order they apply to the old text.
+
+def ndiff(old, new):
+    """
+        Edit script of difflib.ndiff. Kept for comparison with older results.
+    """
+    for line in difflib.ndiff(old, new):
+        # Skip the intraline hints completely.
+        if line[0] != '?':
+            yield line[0], 1
+
+
+
+
+def _intern(old, new):
+    """
+        Maps the words of old and new to integer ids so they compare as ints.
+        Sequences of ids are returned as lists.
+    """
+    if hasattr(old, 'tolist'):
+        old = old.tolist()
+    if hasattr(new, 'tolist'):
+        new = new.tolist()
+    if (not old or isinstance(old[0], int)) and \
+       (not new or isinstance(new[0], int)):
+        return old, new
+
+    ids = {}
+    old = [ids.setdefault(word, len(ids)) for word in old]
+    new = [ids.setdefault(word, len(ids)) for word in new]
+    return old, new
+
+
+
+
+def _middle_snake(a, alo, ahi, b, blo, bhi):
+    """
+        Finds the middle snake of a shortest edit script between a[alo:ahi]
+            and b[blo:bhi] by searching from both ends at once (Myers 1986).
+        Returns the snake as (x, y, u, v), the matching run
+            a[x:u] == b[y:v], and the number of edits D in the script.
+    """
+    N = ahi - alo
+    M = bhi - blo
+    delta = N - M
+    odd = delta & 1
+    off = N + M + 1
+    vf = [0] * (2 * off + 1)
+    vb = [0] * (2 * off + 1)
+
+    for d in xrange((N + M + 1) // 2 + 1):
+        # Forward paths
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and vf[off + k - 1] < vf[off + k + 1]):
+                x = vf[off + k + 1]
+            else:
+                x = vf[off + k - 1] + 1
+            y = x - k
+            sx = x
+            while x < N and y < M and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vf[off + k] = x
+            if odd and delta - d < k < delta + d and \
+               x + vb[off + delta - k] >= N:
+                return (alo + sx, blo + sx - k, alo + x, blo + y), 2 * d - 1
+
+        # Backward paths, measured from the ends of a and b
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and vb[off + k - 1] < vb[off + k + 1]):
+                x = vb[off + k + 1]
+            else:
+                x = vb[off + k - 1] + 1
+            y = x - k
+            sx = x
+            while x < N and y < M and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            vb[off + k] = x
+            if not odd and -d <= delta - k <= d and \
+               x + vf[off + delta - k] >= N:
+                return (ahi - x, bhi - y, ahi - sx, bhi - sx + k), 2 * d
+
+    assert False
+
+
+
+
+def _matching_blocks(a, b):
+    """
+        Returns the runs of a and b kept by a shortest edit script, as
+            sorted (i, j, n) triples with a[i:i+n] == b[j:j+n].
+    """
+    blocks = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        (alo, ahi, blo, bhi) = stack.pop()
+
+        # Common prefix and suffix
+        i = alo
+        j = blo
+        while i < ahi and j < bhi and a[i] == b[j]:
+            i += 1
+            j += 1
+        if i > alo:
+            blocks.append((alo, blo, i - alo))
+        (alo, blo) = (i, j)
+        i = ahi
+        j = bhi
+        while i > alo and j > blo and a[i - 1] == b[j - 1]:
+            i -= 1
+            j -= 1
+        if i < ahi:
+            blocks.append((i, j, ahi - i))
+        (ahi, bhi) = (i, j)
+
+        # Only insertions or only deletions are left
+        if alo == ahi or blo == bhi:
+            continue
+
+        ((x, y, u, v), d) = _middle_snake(a, alo, ahi, b, blo, bhi)
+        if u > x:
+            blocks.append((x, y, u - x))
+        stack.append((u, ahi, v, bhi))
+        stack.append((alo, x, blo, y))
+
+    blocks.sort()
+    return _slide(a, b, blocks)
+
+
+
+
+def _slide(a, b, blocks):
+    """
+        Moves each pure insertion or deletion that could be placed at several
+            positions to where ndiff puts it: the kept run on either side is
+            extended as far as it goes and the longer one wins, the earlier
+            one on ties.
+    """
+    # Merge touching runs
+    merged = []
+    for (i, j, n) in blocks:
+        if merged and merged[-1][0] + merged[-1][2] == i and \
+           merged[-1][1] + merged[-1][2] == j:
+            merged[-1][2] += n
+        else:
+            merged.append([i, j, n])
+
+    for k in xrange(1, len(merged)):
+        left = merged[k - 1]
+        right = merged[k]
+        if left[2] == 0:
+            continue
+        if left[0] + left[2] == right[0]:
+            (seq, lo, hi) = (b, left[1] + left[2], right[1])
+        elif left[1] + left[2] == right[1]:
+            (seq, lo, hi) = (a, left[0] + left[2], right[0])
+        else:
+            continue
+
+        # How far the changed run seq[lo:hi] can move either way
+        back = 0
+        while back < left[2] and seq[lo - 1 - back] == seq[hi - 1 - back]:
+            back += 1
+        ahead = 0
+        while ahead < right[2] and seq[lo + ahead] == seq[hi + ahead]:
+            ahead += 1
+
+        shift = ahead if left[2] + ahead >= right[2] + back else -back
+        left[2] += shift
+        right[0] += shift
+        right[1] += shift
+        right[2] -= shift
+
+    return [tuple(block) for block in merged if block[2]]
+
+
+
+
+def myers(old, new):
+    """
+        Edit script of a shortest (O(ND)) diff of the interned words.
+        Each replaced block is emitted in the order ndiff uses for it: the
+            shorter side first. Where difflib's longest-match-first alignment
+            is not a shortest one, the script, and so the Patches, differ
+            from those of ndiff and matcher.
+    """
+    (a, b) = _intern(old, new)
+    i = 0
+    j = 0
+    for (bi, bj, n) in _matching_blocks(a, b) + [(len(a), len(b), 0)]:
+        dels = bi - i
+        adds = bj - j
+        if dels and adds and adds < dels:
+            yield '+', adds
+            yield '-', dels
+        else:
+            if dels:
+                yield '-', dels
+            if adds:
+                yield '+', adds
+        if n:
+            yield ' ', n
+        i = bi + n
+        j = bj + n
+
+
+
+
+def matcher(old, new):
+    """
+        Edit script of difflib.ndiff, computed the way ndiff does without its
+            intraline hints: the interned words are aligned as difflib's
+            SequenceMatcher aligns them, and each replaced block is split at
+            its most similar pair of words, as Differ._fancy_replace does.
+    """
+    (a, b) = _intern(old, new)
+    i = 0
+    j = 0
+    for (ai, bj, n) in _difflib_blocks(a, b):
+        if i < ai and j < bj:
+            for run in _replace(old, a, i, ai, new, b, j, bj):
+                yield run
+        elif i < ai:
+            yield '-', ai - i
+        elif j < bj:
+            yield '+', bj - j
+        if n:
+            yield ' ', n
+        (i, j) = (ai + n, bj + n)
+
+
+
+
+def _difflib_blocks(a, b):
+    """
+        Returns SequenceMatcher(None, a, b).get_matching_blocks() for lists
+            of ints, with the same autojunk rule. The longest match of each
+            block is found with arrays of all the pairs of equal ids, not a
+            word at a time.
+    """
+    (av, bv) = (np.array(a, dtype=np.int64), np.array(b, dtype=np.int64))
+    (i, j) = _pairs(av, bv)
+    blocks = []
+    queue = [(0, len(a), 0, len(b), i, j)]
+    while queue:
+        (alo, ahi, blo, bhi, i, j) = queue.pop()
+        keep = (i >= alo) & (i < ahi) & (j >= blo) & (j < bhi)
+        (i, j) = (i[keep], j[keep])
+        (bi, bj, k) = _longest_match(a, b, i, j, alo, ahi, blo, bhi)
+        if k:
+            blocks.append((bi, bj, k))
+            if alo < bi and blo < bj:
+                queue.append((alo, bi, blo, bj, i, j))
+            if bi + k < ahi and bj + k < bhi:
+                queue.append((bi + k, ahi, bj + k, bhi, i, j))
+    blocks.sort()
+
+    # Join adjacent blocks
+    merged = []
+    for (bi, bj, k) in blocks:
+        if merged and merged[-1][0] + merged[-1][2] == bi and \
+           merged[-1][1] + merged[-1][2] == bj:
+            merged[-1][2] += k
+        else:
+            merged.append([bi, bj, k])
+    return [tuple(block) for block in merged] + [(len(a), len(b), 0)]
+
+
+
+
+def _pairs(a, b):
+    """
+        Returns the positions (i, j) of all the pairs a[i] == b[j], but for
+            the ids SequenceMatcher deems popular in b, sorted by diagonal
+            i - j and then by i.
+    """
+    order = np.argsort(b, kind='mergesort')
+    bs = b[order]
+    if len(b) >= 200:
+        (values, counts) = np.unique(bs, return_counts=True)
+        popular = values[counts > len(b)//100 + 1]
+        common = np.in1d(bs, popular)
+        (order, bs) = (order[~common], bs[~common])
+
+    lo = np.searchsorted(bs, a, 'left')
+    counts = np.searchsorted(bs, a, 'right') - lo
+    total = counts.sum()
+    i = np.repeat(np.arange(len(a), dtype=np.int64), counts)
+    first = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    j = order[first + np.arange(total, dtype=np.int64)]
+    # The pairs are in order of i, which a stable sort keeps
+    diagonal = np.argsort(i - j, kind='mergesort')
+    return i[diagonal], j[diagonal]
+
+
+
+
+def _longest_match(a, b, i, j, alo, ahi, blo, bhi):
+    """
+        SequenceMatcher.find_longest_match over the pairs (i, j) in the
+            block: the longest run of pairs along a diagonal, the first by
+            its start in a then in b, extended over equal popular ids.
+    """
+    (besti, bestj, bestsize) = (alo, blo, 0)
+    if len(i):
+        d = i - j
+        runs = np.ones(len(i), dtype=bool)
+        runs[1:] = (d[1:] != d[:-1]) | (i[1:] != i[:-1] + 1)
+        starts = np.flatnonzero(runs)
+        lengths = np.diff(np.append(starts, len(i)))
+        bestsize = int(lengths.max())
+        longest = starts[lengths == bestsize]
+        best = longest[np.lexsort((j[longest], i[longest]))[0]]
+        (besti, bestj) = (int(i[best]), int(j[best]))
+
+    while besti > alo and bestj > blo and a[besti-1] == b[bestj-1]:
+        (besti, bestj, bestsize) = (besti - 1, bestj - 1, bestsize + 1)
+    while besti + bestsize < ahi and bestj + bestsize < bhi and \
+          a[besti + bestsize] == b[bestj + bestsize]:
+        bestsize += 1
+    return besti, bestj, bestsize
+
+
+
+
+def _replace(old, a, alo, ahi, new, b, blo, bhi):
+    """
+        Edit script of the replaced block old[alo:ahi] to new[blo:bhi], a and
+            b being their interned ids, as Differ._fancy_replace makes it.
+        Blocks are split with a stack instead of by recursion.
+    """
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        block = stack.pop()
+        if block[0] == '=':
+            yield block[1], 1
+            continue
+        (alo, ahi, blo, bhi) = block
+        if alo == ahi:
+            if blo < bhi:
+                yield '+', bhi - blo
+            continue
+        if blo == bhi:
+            yield '-', ahi - alo
+            continue
+
+        # The most similar pair of different words, past the cutoff, else
+        #   the first pair of equal words
+        (best, cutoff) = (0.74, 0.75)
+        eq = None
+        cruncher = difflib.SequenceMatcher(difflib.IS_CHARACTER_JUNK)
+        for j in xrange(blo, bhi):
+            (bj, idj) = (new[j], b[j])
+            lb = len(bj)
+            counts = None
+            chained = False
+            for i in xrange(alo, ahi):
+                if a[i] == idj:
+                    if eq is None:
+                        eq = (i, j)
+                    continue
+                ai = old[i]
+                la = len(ai)
+                # SequenceMatcher.real_quick_ratio
+                if 2.0*min(la, lb)/(la+lb) <= best:
+                    continue
+                # SequenceMatcher.quick_ratio
+                if counts is None:
+                    counts = {}
+                    for c in bj:
+                        counts[c] = counts.get(c, 0) + 1
+                avail = {}
+                matches = 0
+                for c in ai:
+                    n = avail[c] if c in avail else counts.get(c, 0)
+                    avail[c] = n - 1
+                    if n > 0:
+                        matches += 1
+                if 2.0*matches/(la+lb) <= best:
+                    continue
+                if not chained:
+                    cruncher.set_seq2(bj)
+                    chained = True
+                cruncher.set_seq1(ai)
+                ratio = cruncher.ratio()
+                if ratio > best:
+                    (best, pair) = (ratio, (i, j))
+
+        if best < cutoff:
+            if eq is None:
+                # Differ._plain_replace: the shorter side first
+                if bhi - blo < ahi - alo:
+                    yield '+', bhi - blo
+                    yield '-', ahi - alo
+                else:
+                    yield '-', ahi - alo
+                    yield '+', bhi - blo
+                continue
+            (i, j) = eq
+            middle = [('=', ' ')]
+        else:
+            (i, j) = pair
+            middle = [('=', '-'), ('=', '+')]
+        stack.append((i + 1, ahi, j + 1, bhi))
+        stack.extend(reversed(middle))
+        stack.append((alo, i, blo, j))
+
+
+
+
+ENGINES = {'matcher': matcher, 'myers': myers, 'ndiff': ndiff}
+WORD_ENGINES = set(['matcher', 'ndiff'])   # Engines that need the words, not their ids
+
+
+
+
+class _Span(object):
+    """
+        A node of a SpanTree: one span and the totals of its subtree.
+        epoch is the version of a persistent SpanTree that may change it
+            in place, None if it is not persistent.
+    """
+    __slots__ = ('left', 'right', 'length', 'pid', 'priority', 'count', 'total',
+                 'epoch')
+
+    def __init__(self, length, pid, epoch=None):
+        self.left = None
+        self.right = None
+        self.length = length
+        self.pid = pid
+        self.priority = random.random()
+        self.count = 1
+        self.total = length
+        self.epoch = epoch
+
+    def copy(self, epoch):
+        node = _Span.__new__(_Span)
+        node.left = self.left
+        node.right = self.right
+        node.length = self.length
+        node.pid = self.pid
+        node.priority = self.priority
+        node.count = self.count
+        node.total = self.total
+        node.epoch = epoch
+        return node
+
+    def update(self):
+        count = 1
+        total = self.length
+        if self.left is not None:
+            count += self.left.count
+            total += self.left.total
+        if self.right is not None:
+            count += self.right.count
+            total += self.right.total
+        self.count = count
+        self.total = total
+
+
+
+
+def _split(node, k, epoch=None):
+    """
+        Splits the treap at node into its first k spans and the rest.
+        Nodes of another epoch than a given one are copied, not changed.
+    """
+    if node is None:
+        return None, None
+    if epoch is not None and node.epoch is not epoch:
+        node = node.copy(epoch)
+    lcount = node.left.count if node.left is not None else 0
+    if k <= lcount:
+        (left, node.left) = _split(node.left, k, epoch)
+        node.update()
+        return left, node
+    else:
+        (node.right, right) = _split(node.right, k - lcount - 1, epoch)
+        node.update()
+        return node, right
+
+
+
+
+def _merge(left, right, epoch=None):
+    """
+        Joins 2 treaps, all spans of left coming first.
+        Nodes of another epoch than a given one are copied, not changed.
+    """
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        if epoch is not None and left.epoch is not epoch:
+            left = left.copy(epoch)
+        left.right = _merge(left.right, right, epoch)
+        left.update()
+        return left
+    else:
+        if epoch is not None and right.epoch is not epoch:
+            right = right.copy(epoch)
+        right.left = _merge(left, right.left, epoch)
+        right.update()
+        return right
+
+
+
+
+class SpanTree(object):
+    """
+        A sorted list of (end index, Patch ID) spans, stored as a treap of
+            span lengths so that an end is the sum of the lengths before it.
+        Shifting every later span is then a change to a single length, and
+            lookups, insertions and deletions all take O(log n).
+        Indexing, insert, delete, set and shift behave like the same
+            operations on a plain list of (end, pid): the ends of untouched
+            spans do not move.
+        A persistent tree copies the nodes on the path it changes instead
+            of changing them, once a snapshot shares them, so every snapshot
+            stays as it was for O(log n) new nodes per operation.
+    """
+
+    def __init__(self, spans=(), persistent=False):
+        self.root = None
+        self.epoch = object() if persistent else None
+        self.extend(spans)
+
+    def extend(self, spans):
+        """
+            Appends the spans (end, pid), whose ends must keep increasing.
+            They are built into a treap in linear time, with a stack of its
+                right spine, then joined to the tree.
+        """
+        last = self._end(len(self))
+        stack = []
+        child = None
+        for (end, pid) in spans:
+            node = _Span(end - last, pid, self.epoch)
+            last = end
+            child = None
+            while stack and stack[-1].priority < node.priority:
+                child = stack.pop()
+                child.update()
+            node.left = child
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+        while stack:
+            child = stack.pop()
+            child.update()
+        if child is not None:
+            self.root = _merge(self.root, child, self.epoch)
+
+    def clear(self):
+        self.root = None
+
+    def snapshot(self):
+        """
+            Returns a SpanTree of the current spans of a persistent tree, in
+                O(1). Neither tree changes the nodes they share.
+        """
+        assert self.epoch is not None, "Only a persistent SpanTree has snapshots."
+        tree = SpanTree(persistent=True)
+        tree.root = self.root
+        self.epoch = object()
+        return tree
+
+    def __len__(self):
+        return self.root.count if self.root is not None else 0
+
+    def __iter__(self):
+        stack = []
+        node = self.root
+        end = 0
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                end += node.length
+                yield end, node.pid
+                node = node.right
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("span index out of range")
+        node = self.root
+        end = 0
+        while True:
+            lcount = node.left.count if node.left is not None else 0
+            if i < lcount:
+                node = node.left
+            else:
+                if node.left is not None:
+                    end += node.left.total
+                end += node.length
+                if i == lcount:
+                    return end, node.pid
+                i -= lcount + 1
+                node = node.right
+
+    def spans(self, lo, hi):
+        """
+            Returns the spans lo to hi as a list, like a list slice.
+        """
+        return [self[i] for i in xrange(lo, min(hi, len(self)))]
+
+    def _bisect(self, x, right):
+        """
+            Counts the spans whose end is before x, or at most x if right.
+        """
+        node = self.root
+        end = 0
+        index = 0
+        while node is not None:
+            lend = end + (node.left.total if node.left is not None else 0)
+            if lend + node.length < x or (right and lend + node.length == x):
+                index += (node.left.count if node.left is not None else 0) + 1
+                end = lend + node.length
+                node = node.right
+            else:
+                node = node.left
+        return index
+
+    def bisect_left(self, x):
+        return self._bisect(x, False)
+
+    def bisect_right(self, x):
+        return self._bisect(x, True)
+
+    def _end(self, i):
+        """The end of span i, or 0 before the first span"""
+        return self[i - 1][0] if i > 0 else 0
+
+    def _add(self, i, delta):
+        """
+            Lengthens span i, and so moves the ends of all the spans from
+                i on, by delta.
+        """
+        if not 0 <= i < len(self) or delta == 0:
+            return
+        persistent = self.epoch is not None
+        if persistent:
+            self.root = self._own(self.root)
+        node = self.root
+        while True:
+            node.total += delta
+            lcount = node.left.count if node.left is not None else 0
+            if i < lcount:
+                if persistent:
+                    node.left = self._own(node.left)
+                node = node.left
+            elif i == lcount:
+                node.length += delta
+                return
+            else:
+                i -= lcount + 1
+                if persistent:
+                    node.right = self._own(node.right)
+                node = node.right
+
+    def _own(self, node):
+        """The node, or a copy of it a persistent tree can change"""
+        if node.epoch is not self.epoch:
+            return node.copy(self.epoch)
+        return node
+
+    def insert(self, i, end, pid):
+        """
+            Inserts the span (end, pid) before span i.
+        """
+        length = end - self._end(i)
+        self._add(i, -length)
+        (left, right) = _split(self.root, i, self.epoch)
+        self.root = _merge(_merge(left, _Span(length, pid, self.epoch),
+                                  self.epoch), right, self.epoch)
+
+    def delete(self, lo, hi):
+        """
+            Removes spans lo to hi.
+        """
+        if hi <= lo:
+            return
+        (left, right) = _split(self.root, hi, self.epoch)
+        (left, middle) = _split(left, lo, self.epoch)
+        self.root = _merge(left, right, self.epoch)
+        if middle is not None:
+            self._add(lo, middle.total)
+
+    def set(self, i, end, pid):
+        """
+            Replaces span i with (end, pid).
+        """
+        (old, opid) = self[i]
+        self._add(i + 1, old - end)
+        self._add(i, end - old)
+        persistent = self.epoch is not None
+        if persistent:
+            self.root = self._own(self.root)
+        node = self.root
+        while True:
+            lcount = node.left.count if node.left is not None else 0
+            if i < lcount:
+                if persistent:
+                    node.left = self._own(node.left)
+                node = node.left
+            elif i == lcount:
+                node.pid = pid
+                return
+            else:
+                i -= lcount + 1
+                if persistent:
+                    node.right = self._own(node.right)
+                node = node.right
+
+    def shift(self, i, delta):
+        """
+            Moves the ends of the spans from i on by delta.
+        """
+        self._add(i, delta)
+
+
+
 
 class PatchModel:
     """
         A PatchModel model gives ownership of indices of the current text to
             the Patch that last modified that section of text.
+        With persistent, model.snapshot() keeps the spans as they are, for
+            O(log n) new nodes per later change to them.
     """
-    model=[]   # A sorted list of end indices and Patch IDs.
-    graph = nx.DiGraph()
+
+    def __init__(self, spans=(), graph=None, persistent=False):
+        # A sorted list of end indices and Patch IDs.
+        self.model = SpanTree(persistent=persistent)
+        self.graph = GraphBuilder()   # Built into a CSRGraph once all Patches are in.
+        self.reset(spans, graph)
+
+    def reset(self, spans=(), graph=None):
+        """
+            Empties the model so it can be applied to another history, or
+                restores it to spans and graph, a CSRGraph, saved from an
+                earlier application.
+            The span tree and graph builder are kept, so a process applying
+                the model to many pages can reuse one PatchModel.
+        """
+        self.model.clear()
+        self.model.extend(spans)
+        self.graph.clear()
+        if graph is not None:
+            self.graph.extend(graph)
 
 
-    def apply_patch(self, p, timestamp, dist):
+    def apply_patch(self, p, minute, dist):
         """
-            Adds Patch, p, to the model and graph
+            Adds Patch, p, to the model and graph. minute is the time of its
+                revision in minutes since the epoch.
         """
-        self.graph.add_node(p.pid, time = timestamp, size=p.length)
+        self.graph.add_node(p.pid, time = minute, size=p.length)
         if not self.model:
-            self.model.append((p.end, p.pid))
+            self.model.insert(0, p.end, p.pid)
         
         elif p.ptype == PatchType.ADD:
             # Find indices that share a range with p
-            sin = bisect.bisect_left(
-                [end for (end, pid) in self.model], p.start)
-            ein = bisect.bisect_right(
-                [end for (end, pid) in self.model], p.start)
+            sin = self.model.bisect_left(p.start)
+            ein = self.model.bisect_right(p.start)
 
             # Add dependencies
 
@@ -158,11 +909,11 @@ class PatchModel:
 
                 total=0
                 nstart=start
-                for (end, pid) in self.model[sin:(ein + 1)]:
+                for (end, pid) in self.model.spans(sin, ein + 1):
                     total+=end-nstart
                     nstart=end
                 nstart=start
-                for (end, pid) in self.model[sin:(ein + 1)]:
+                for (end, pid) in self.model.spans(sin, ein + 1):
                     length=end-nstart
                     nstart=end
                     prob=float(length)/total
@@ -175,7 +926,7 @@ class PatchModel:
                 # Only include deletes in range
                 start=p.start
                 total=0
-                for (end, pid) in self.model[sin:(ein + 1)]:
+                for (end, pid) in self.model.spans(sin, ein + 1):
                     if p.end<end:
                         length=p.end-start
                     else:
@@ -183,53 +934,35 @@ class PatchModel:
                         start=end
                     # Delete patches act like invisible text
                     if length==0:
-                        total+=self.graph.node[pid]['size']
+                        total+=self.graph.nodeSize(pid)
     
                 # Add dependencies to graph with weights
                 start=p.start
-                for (end, pid) in self.model[sin:(ein + 1)]:
+                for (end, pid) in self.model.spans(sin, ein + 1):
                     if p.end<end:
                         length=p.end-start
                     else:
                         length=end-start
                         start=end
                     if length==0:
-                        length=self.graph.node[pid]['size']
+                        length=self.graph.nodeSize(pid)
                         prob=float(length)/total
                         self.graph.add_edge(p.pid, pid, prob=prob, dist=dist)
 
 
 
-            # Remove intermediates if present.
-            # Leave the first preceeding Patch
-            if sin != ein:
-                del self.model[(sin + 1):ein]
-            # Else, split the surrounding span.
-            else:
-                (end, pid) = self.model[sin]
-                self.model.insert(sin, (p.start, pid))
-            ein = sin + 1
-
-            # Insert.
-            self.model.insert(ein, (p.end, p.pid))
-
-            # Update proceeding spans.
-            self.model[(ein + 1):] = \
-                [(end + p.length, pid) for (end, pid) \
-                in self.model[(ein + 1):]]
+            self._add_spans(p, sin, ein)
 
 
         elif p.ptype == PatchType.DELETE:
             # Find indices of Patches who fall in the deleted range.
-            sin = bisect.bisect_right(
-                [end for (end, pid) in self.model], p.start)
-            ein = bisect.bisect_left(
-                [end for (end, pid) in self.model], p.end)
+            sin = self.model.bisect_right(p.start)
+            ein = self.model.bisect_left(p.end)
 
             # Get total size of dependencies to find weight of dependence
             start=p.start
             total=0
-            for (end, pid) in self.model[sin:(ein + 1)]:
+            for (end, pid) in self.model.spans(sin, ein + 1):
                 if p.end<end:
                     length=p.end-start
                 else:
@@ -237,49 +970,90 @@ class PatchModel:
                     start=end
                 # Delete patches act like invisible text
                 if length==0:
-                    total+=self.graph.node[pid]['size']
+                    total+=self.graph.nodeSize(pid)
                 else:
                     total+=length
 
             # Add dependencies to graph with weights
             start=p.start
-            for (end, pid) in self.model[sin:(ein + 1)]:
+            for (end, pid) in self.model.spans(sin, ein + 1):
                 if p.end<end:
                     length=p.end-start
                 else:
                     length=end-start
                     start=end
                 if length==0:
-                    length=self.graph.node[pid]['size']
+                    length=self.graph.nodeSize(pid)
                 prob=float(length)/total
 
                 self.graph.add_edge(p.pid, pid, prob=prob, dist=dist)
 
 
-            # Adjust indices to include Patches that end where p starts
-            #   or end where p ends.
-            if sin != bisect.bisect_left(
-               [end for (end, pid) in self.model], p.start): sin -= 1
-            if ein != bisect.bisect_right(
-                [end for (end, pid) in self.model], p.end): ein += 1
+            self._delete_spans(p, sin, ein)
+
+        else:
+            assert False
+
+    def apply_spans(self, p):
+        """
+            Gives the text of Patch, p, to it in the model only, leaving the
+                graph alone, as when the model is replayed from a checkpoint.
+        """
+        if not self.model:
+            self.model.insert(0, p.end, p.pid)
+        elif p.ptype == PatchType.ADD:
+            self._add_spans(p, self.model.bisect_left(p.start),
+                            self.model.bisect_right(p.start))
+        elif p.ptype == PatchType.DELETE:
+            self._delete_spans(p, self.model.bisect_right(p.start),
+                               self.model.bisect_left(p.end))
+        else:
+            assert False
 
-            # Shrink the preceding span and remove intermediates if present
+    def _add_spans(self, p, sin, ein):
+        """
+            Inserts added Patch, p, into the model. sin and ein are the first
+                span ending at or after its start and the first ending after.
+        """
+        # Remove intermediates if present.
+        # Leave the first preceeding Patch
+        if sin != ein:
+            self.model.delete(sin + 1, ein)
+        # Else, split the surrounding span.
+        else:
             (end, pid) = self.model[sin]
-            if sin != ein:
-                self.model[sin] = (p.start, pid)
-                del self.model[(sin + 1):ein]
-            # Else, split the surrounding span.
-            else:
-                self.model.insert(sin, (p.start, pid))
-            ein = sin + 1
+            self.model.insert(sin, p.start, pid)
+        ein = sin + 1
 
-            # Insert.
-            self.model.insert(ein, (p.start, p.pid))
+        # Insert.
+        self.model.insert(ein, p.end, p.pid)
 
-            # Update the proceeding spans.
-            self.model[(ein + 1):] = \
-                [(end - p.length, pid) for (end, pid) \
-                in self.model[(ein + 1):]]
+        # Update proceeding spans.
+        self.model.shift(ein + 1, p.length)
 
+    def _delete_spans(self, p, sin, ein):
+        """
+            Replaces the text deleted by Patch, p, with an empty span. sin and
+                ein are the first span ending after its start and the first
+                ending at or after its end.
+        """
+        # Adjust indices to include Patches that end where p starts
+        #   or end where p ends.
+        if sin != self.model.bisect_left(p.start): sin -= 1
+        if ein != self.model.bisect_right(p.end): ein += 1
+
+        # Shrink the preceding span and remove intermediates if present
+        (end, pid) = self.model[sin]
+        if sin != ein:
+            self.model.set(sin, p.start, pid)
+            self.model.delete(sin + 1, ein)
+        # Else, split the surrounding span.
         else:
-            assert False
+            self.model.insert(sin, p.start, pid)
+        ein = sin + 1
+
+        # Insert.
+        self.model.insert(ein, p.start, p.pid)
+
+        # Update the proceeding spans.
+        self.model.shift(ein + 1, -p.length)
@@ -0,0 +1,398 @@
+#!/usr/bin/python
+
+# A compact, array-backed replacement for the networkx DiGraph of Patch
+#   dependencies. Edges are kept in compressed sparse row (CSR) order with one
+#   array per attribute, and the read API follows the parts of networkx that
+#   the metrics use.
+
+import numpy as np
+from array import array
+import networkx as nx
+import timestamp as ts
+
+
+
+
+class GraphBuilder(object):
+    """
+        Collects the nodes and edges of a graph as they are added, then
+            builds a CSRGraph from them.
+        Adding an edge twice keeps the attributes of the last one, as in
+            networkx.
+    """
+
+    def __init__(self):
+        self.nodeIds = array('l')
+        self.sizes = array('i')
+        self.times = array('l')
+        self.srcs = array('l')
+        self.dsts = array('l')
+        self.probs = array('f')
+        self.dists = array('f')
+        self.index = None   # Positions of the nodes, unless the ids are 0..n-1
+        self.node = _NodeView(self)
+
+    @classmethod
+    def fromGraph(cls, graph):
+        """
+            Returns a builder holding the nodes and edges of a CSRGraph, so
+                more can be added to it
+        """
+        builder = cls()
+        builder.extend(graph)
+        return builder
+
+    def extend(self, graph):
+        """
+            Adds the nodes and edges of a CSRGraph to an empty builder
+        """
+        assert not len(self), "Can only extend an empty GraphBuilder."
+        self.nodeIds.extend(graph.nodeIds.tolist())
+        self.sizes.extend(graph.size.tolist())
+        self.times.extend(graph.time.tolist())
+        self.srcs.extend(graph.nodeIds[graph.edgeSources()].tolist())
+        self.dsts.extend(graph.nodeIds[graph.indices].tolist())
+        self.probs.extend(graph.prob.tolist())
+        self.dists.extend(graph.dist.tolist())
+        if not graph.dense:
+            self.index = dict((n, i) for (i, n) in enumerate(graph.nodes()))
+
+    def clear(self):
+        """
+            Removes all nodes and edges, keeping the builder
+        """
+        for values in (self.nodeIds, self.sizes, self.times, self.srcs,
+                       self.dsts, self.probs, self.dists):
+            del values[:]
+        self.index = None
+
+    def __len__(self):
+        return len(self.nodeIds)
+
+    def position(self, n):
+        """
+            Returns the position of node n in the node arrays
+        """
+        if self.index is None:
+            if not 0 <= n < len(self.nodeIds):
+                raise KeyError(n)
+            return n
+        return self.index[n]
+
+    def nodeSize(self, n):
+        return int(self.sizes[self.position(n)])
+
+    def nodeData(self, n):
+        """
+            Returns the attributes of node n as a dictionary
+        """
+        i = self.position(n)
+        return {'time': int(self.times[i]),
+                'size': int(self.sizes[i])}
+
+    def add_node(self, n, time, size):
+        if self.index is None and n != len(self.nodeIds):
+            self.index = dict((m, i) for (i, m) in enumerate(self.nodeIds))
+        if self.index is not None:
+            self.index[n] = len(self.nodeIds)
+
+        self.nodeIds.append(n)
+        self.times.append(time)
+        self.sizes.append(size)
+
+    def add_edge(self, u, v, prob, dist):
+        self.srcs.append(u)
+        self.dsts.append(v)
+        self.probs.append(prob)
+        self.dists.append(dist)
+
+    def build(self):
+        """
+            Returns the CSRGraph of the nodes and edges added so far
+        """
+        return CSRGraph.fromArrays(
+            np.array(self.nodeIds, np.int64), np.array(self.times, np.int64),
+            np.array(self.sizes, np.int32), np.array(self.srcs, np.int64),
+            np.array(self.dsts, np.int64), np.array(self.probs, np.float32),
+            np.array(self.dists, np.float32))
+
+
+
+
+class _NodeView(object):
+    """
+        graph.node[n] gives the attributes of node n as a dictionary
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, n):
+        return self.graph.nodeData(n)
+
+
+
+
+class _EdgeView(object):
+    """
+        graph.edge[u][v] gives the attributes of edge (u, v) as a dictionary
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, u):
+        g = self.graph
+        i = g.position(u)
+        (lo, hi) = (g.indptr[i], g.indptr[i+1])
+        return dict((int(g.nodeIds[j]), {'prob': float(p), 'dist': float(d)})
+                    for (j, p, d) in zip(g.indices[lo:hi], g.prob[lo:hi],
+                                         g.dist[lo:hi]))
+
+
+
+
+class CSRGraph(object):
+    """
+        A directed graph with integer node ids. Node i (in increasing id
+            order) has the out-edges indptr[i] to indptr[i+1], whose targets
+            are the node positions in indices.
+        Per node: nodeIds (int64), time (int64, minutes since the epoch) and
+            size (int32). Per edge: prob and dist (float32).
+    """
+
+    def __init__(self, nodeIds, indptr, indices, time, size, prob, dist):
+        self.nodeIds = nodeIds
+        self.indptr = indptr
+        self.indices = indices
+        self.time = time
+        self.size = size
+        self.prob = prob
+        self.dist = dist
+        self.dense = len(nodeIds) == 0 or \
+            (nodeIds[0] == 0 and nodeIds[-1] == len(nodeIds) - 1)
+        self.node = _NodeView(self)
+        self.edge = _EdgeView(self)
+
+    @classmethod
+    def fromArrays(cls, nodeIds, time, size, srcs, dsts, prob, dist):
+        """
+            Builds a CSRGraph from per-node arrays and per-edge (src, dst)
+                arrays of node ids. Of repeated edges, the last one is kept.
+        """
+        order = np.argsort(nodeIds, kind='mergesort')
+        nodeIds = nodeIds[order]
+        time = time[order]
+        size = size[order]
+
+        src = np.searchsorted(nodeIds, srcs)
+        dst = np.searchsorted(nodeIds, dsts)
+
+        # Sort edges by source then target, the last added one first
+        seq = np.arange(len(src))
+        order = np.lexsort((-seq, dst, src))
+        src = src[order]
+        dst = dst[order]
+        first = np.ones(len(src), dtype=bool)
+        first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+        order = order[first]
+        src = src[first]
+
+        indptr = np.zeros(len(nodeIds) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(nodeIds)), out=indptr[1:])
+        return cls(nodeIds, indptr, dst[first].astype(np.int64), time, size,
+                   prob[order], dist[order])
+
+    @classmethod
+    def fromDiGraph(cls, graph):
+        """
+            Converts a networkx DiGraph, e.g. one read from a GML file, whose
+                nodes have time and size attributes and whose edges have prob
+                and dist attributes.
+        """
+        nodes = graph.nodes(data=True)
+        edges = graph.edges(data=True)
+        return cls.fromArrays(
+            np.array([_nodeId(n) for (n, d) in nodes], np.int64),
+            np.array([_minute(d['time']) for (n, d) in nodes], np.int64),
+            np.array([d['size'] for (n, d) in nodes], np.int32),
+            np.array([_nodeId(u) for (u, v, d) in edges], np.int64),
+            np.array([_nodeId(v) for (u, v, d) in edges], np.int64),
+            np.array([d['prob'] for (u, v, d) in edges], np.float32),
+            np.array([d['dist'] for (u, v, d) in edges], np.float32))
+
+    def toDiGraph(self):
+        """
+            Returns the graph as a networkx DiGraph
+        """
+        graph = nx.DiGraph()
+        for n in self.nodes():
+            graph.add_node(n, **self.node[n])
+        for (u, v, d) in self.edges_iter(data=True):
+            graph.add_edge(u, v, **d)
+        return graph
+
+    def position(self, n):
+        """
+            Returns the position of node n in the node arrays
+        """
+        if self.dense:
+            if not 0 <= n < len(self.nodeIds):
+                raise KeyError(n)
+            return n
+        i = int(np.searchsorted(self.nodeIds, n))
+        if i == len(self.nodeIds) or self.nodeIds[i] != n:
+            raise KeyError(n)
+        return i
+
+    def nodeSize(self, n):
+        return int(self.size[self.position(n)])
+
+    def nodeData(self, n):
+        """
+            Returns the attributes of node n as a dictionary
+        """
+        i = self.position(n)
+        return {'time': int(self.time[i]),
+                'size': int(self.size[i])}
+
+    def edgeSources(self):
+        """
+            Returns the position of the source of every edge
+        """
+        return np.repeat(np.arange(len(self.nodeIds), dtype=np.int64),
+                         np.diff(self.indptr))
+
+    def head(self, m):
+        """
+            Returns the graph of the first m nodes and their out-edges, which
+                lead to earlier Patches only, over views of the arrays
+        """
+        e = self.indptr[m]
+        return CSRGraph(self.nodeIds[:m], self.indptr[:m+1], self.indices[:e],
+                        self.time[:m], self.size[:m], self.prob[:e],
+                        self.dist[:e])
+
+    def __len__(self):
+        return len(self.nodeIds)
+
+    def __iter__(self):
+        return iter(self.nodes())
+
+    def __contains__(self, n):
+        try:
+            self.position(n)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def number_of_nodes(self):
+        return len(self.nodeIds)
+
+    def number_of_edges(self):
+        return len(self.indices)
+
+    def nodes(self):
+        return self.nodeIds.tolist()
+
+    def successors(self, n):
+        i = self.position(n)
+        return self.nodeIds[self.indices[self.indptr[i]:self.indptr[i+1]]].tolist()
+
+    def out_degree(self, n):
+        i = self.position(n)
+        return int(self.indptr[i+1] - self.indptr[i])
+
+    def out_edges_iter(self, nbunch=None, data=False):
+        """
+            Iterates over the out-edges of nbunch (a node or a list of nodes,
+                all nodes if None) as (u, v), (u, v, d) if data is True, or
+                (u, v, d[data]) if data names an attribute.
+        """
+        if nbunch is None:
+            nbunch = self.nodes()
+        elif isinstance(nbunch, (int, long, np.integer)):
+            nbunch = [nbunch]
+
+        for u in nbunch:
+            i = self.position(u)
+            (lo, hi) = (self.indptr[i], self.indptr[i+1])
+            targets = self.nodeIds[self.indices[lo:hi]].tolist()
+            if data is False:
+                for v in targets:
+                    yield u, v
+            elif data is True:
+                for (v, p, d) in zip(targets, self.prob[lo:hi].tolist(),
+                                     self.dist[lo:hi].tolist()):
+                    yield u, v, {'prob': p, 'dist': d}
+            else:
+                values = getattr(self, data)[lo:hi].tolist()
+                for (v, value) in zip(targets, values):
+                    yield u, v, value
+
+    edges_iter = out_edges_iter
+
+    def out_edges(self, nbunch=None, data=False):
+        return list(self.out_edges_iter(nbunch, data))
+
+    edges = out_edges
+
+    def topological_sort(self, reverse=False):
+        """
+            Returns the nodes so that every edge goes from an earlier node to
+                a later one, or the other way around if reverse.
+        """
+        src = self.edgeSources()
+        if np.all(self.indices < src):
+            # Edges point at older Patches: descending ids are an order
+            order = self.nodeIds[::-1]
+        else:
+            order = self.nodeIds[_kahn(self.indptr, self.indices)]
+        if reverse:
+            order = order[::-1]
+        return order.tolist()
+
+
+
+
+def _kahn(indptr, indices):
+    """
+        Returns the node positions of a CSR DAG in topological order
+    """
+    n = len(indptr) - 1
+    indegree = np.bincount(indices, minlength=n)
+    queue = np.flatnonzero(indegree == 0).tolist()
+    indegree = indegree.tolist()
+    order = []
+    while queue:
+        i = queue.pop()
+        order.append(i)
+        for j in indices[indptr[i]:indptr[i+1]].tolist():
+            indegree[j] -= 1
+            if indegree[j] == 0:
+                queue.append(j)
+    assert len(order) == n, "Graph has a cycle."
+    return np.array(order, dtype=np.int64)
+
+
+
+
+def _nodeId(n):
+    """
+        Node labels read back from GML files may be strings
+    """
+    if not isinstance(n, (int, long)):
+        n = int(n.decode("utf-8"))
+    return n
+
+
+
+
+def _minute(time):
+    """
+        Node times in GML files written before they were stored in minutes
+            are Wikipedia timestamps
+    """
+    if isinstance(time, basestring):
+        return ts.ts2minute(time)
+    return time
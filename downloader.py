@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+# Downloads the history of Wikipedia pages through Special:Export into
+#   full_histories, a chunk of up to LIMIT revisions at a time.
+#
+# One requests Session is kept for all the chunks, so the connection is
+#   reused, and responses come gzip encoded and are streamed straight to
+#   disk. A chunk is written to a temporary file and renamed once it is
+#   complete, so an interrupted download never leaves a partial chunk to
+#   be parsed. Chunks can be kept compressed, see textProcessor.openHistory.
+
+import gzip
+import os
+import time
+import requests
+import textProcessor as proc
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+WIKI = 'https://en.wikipedia.org/'
+LIMIT = '1000'
+RETRIES = 5   # Attempts at a chunk before giving up
+BACKOFF = 1.0   # Seconds before the first retry, doubled after each one
+BLOCK = 1 << 16   # Bytes read from a response at a time
+
+_PAGE = '<page>'
+_TIMESTAMP = '<timestamp>'
+_END = '</timestamp>'
+_CLOSE = '</mediawiki>'
+
+
+
+
+class Exporter(object):
+    """
+        Downloads chunks of page histories from wiki, the base URL of a
+            MediaWiki site (or a local stand-in for its Special:Export).
+        compression is None, 'gz' or 'zst', for the cached chunks.
+    """
+
+    def __init__(self, wiki=WIKI, compression=None, retries=RETRIES,
+                 backoff=BACKOFF):
+        assert compression in proc.COMPRESSIONS, \
+            "Unknown compression: "+str(compression)
+        assert compression != 'zst' or zstandard is not None, \
+            "zst compression needs the zstandard package."
+        self.wiki = wiki
+        self.compression = compression
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip'
+
+    def download(self, title, offset='0'):
+        """
+            Downloads the chunks of the history of title from offset on,
+                until a chunk without revisions
+        """
+        i=0
+        while offset!='1':
+            print "Starting set " + str(i) + " . . ."
+            i+=1
+            offset=self.exportChunk(title, offset)
+
+    def exportChunk(self, title, offset):
+        """
+            Downloads up to LIMIT revisions of a Wikipedia page, title
+                starting at offset.
+            Offset '0' gets the first revision.
+            Returns the offset of the next chunk, '1' if this one was the
+                last.
+        """
+        title=title.replace(' ', '_')
+        api = self.wiki+'w/index.php?title=Special:Export&pages='+title+ \
+            '&offset='+offset+'&limit='+LIMIT+'&action=submit'
+
+        # Set up folder for the new history, if needed
+        folder = os.path.dirname(proc.historyFile(title, offset))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        path = proc.historyFile(title, offset, self.compression)
+        tmp = path+'.tmp'
+        for attempt in xrange(self.retries):
+            try:
+                (page, date) = self._stream(api, tmp)
+                break
+            except (requests.RequestException, IOError), e:
+                if os.path.isfile(tmp):
+                    os.remove(tmp)
+                if attempt == self.retries-1:
+                    raise
+                print "Retrying set at "+offset+" ("+str(e)+") . . ."
+                time.sleep(self.backoff*2**attempt)
+
+        # A page without revisions is the end
+        if not page or date is None:
+            os.remove(tmp)
+            return '1'
+        os.rename(tmp, path)
+        return date
+
+    def _stream(self, api, path):
+        """
+            Writes the response to a POST of api to path, and returns
+                whether it has a page and the last timestamp in it
+        """
+        r = self.session.post(api, data="", stream=True)
+        out = None
+        try:
+            r.raise_for_status()
+            out = _openChunk(path, self.compression)
+            # Tags are looked for across block boundaries in a short tail
+            tail = ''
+            page = False
+            date = None
+            for block in r.iter_content(BLOCK):
+                out.write(block)
+                text = tail+block
+                page = page or _PAGE in text
+                start = text.rfind(_TIMESTAMP)
+                if page and start >= 0:
+                    end = text.find(_END, start)
+                    if end >= 0:
+                        date = text[start+len(_TIMESTAMP):end]
+                tail = text[-64:]
+        finally:
+            if out is not None:
+                out.close()
+            r.close()
+        # A connection dropped early can still look like a whole response
+        if not tail.rstrip().endswith(_CLOSE):
+            raise IOError("Export ended early.")
+        return page, date
+
+
+
+
+def _openChunk(path, compression):
+    """
+        Opens path to write a chunk to, compressed with compression
+    """
+    if compression == 'gz':
+        return gzip.open(path, "wb")
+    if compression == 'zst':
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+    return open(path, "wb")
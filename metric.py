@@ -2,53 +2,184 @@
 
 import argparse
 import math
-import networkx as nx
+import numpy as np
+import scipy.sparse as sparse
 import timestamp as ts
+from csrGraph import CSRGraph
 import wiki2graph as w2g
 import metric2color as m2c
+import metricCache
+import modelBundle
+
+
+PROVRANK_ITER = 10000   # Most ProvRank iterations
+PROVRANK_TOL = 1e-12    # ProvRank stops once no score moves more than this
+SUBRANK_MEMORY = 1 << 28   # Bytes of bit rows SubRank works on at a time
+SUBRANK_PRECISION = 8   # log2 of the HyperLogLog registers per node
+DECAY_LOW = 0.01   # Weight of edits a year old or more in tHeight
+METRICS = ['height', 'provrank', 'wprovrank', 'subrank', 'approxsubrank']
+
+def _ranges(starts, counts):
+    """
+        Concatenates the index ranges starts[k] to starts[k]+counts[k]
+    """
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+
+
+
+
+def levels(graph, first=0):
+    """
+        Returns the level of every node of a CSRGraph, by position: 0 for
+            nodes without out-edges, otherwise 1 more than the highest level
+            of the nodes they point to. Nodes of a level only depend on
+            lower levels.
+        With first, the nodes before position first are taken as already
+            done: edges into them are ignored, and their own levels are 0.
+    """
+    n = len(graph)
+    src = graph.edgeSources()
+    dst = graph.indices
+    if first:
+        keep = (src >= first) & (dst >= first)
+        (src, dst) = (src[keep], dst[keep])
+    order = np.argsort(dst, kind='mergesort')
+    inSrc = src[order]
+    inptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(dst, minlength=n), out=inptr[1:])
+
+    # Peel off the nodes whose out-edges all point into lower levels
+    remaining = np.bincount(src, minlength=n)
+    level = np.zeros(n, dtype=np.int64)
+    frontier = np.flatnonzero(remaining == 0)
+    current = 0
+    while len(frontier):
+        level[frontier] = current
+        preds = inSrc[_ranges(inptr[frontier], inptr[frontier + 1] - inptr[frontier])]
+        (preds, counts) = np.unique(preds, return_counts=True)
+        remaining[preds] -= counts
+        frontier = preds[remaining[preds] == 0]
+        current += 1
+
+    assert not remaining.any(), "Graph has a cycle."
+    return level
+
+
+
+
+def heights(graph, scale=None, start=None, prior=None):
+    """
+        The height engine behind tHeight, getAllHeights, getHeight and
+            getHeights.
+        The height of a node is the sum over its out-edges of
+            (height of the target + scale * dist) * prob, where scale is an
+            array with a weight per node (1 if None). Nodes whose time is
+            before start (minutes since the epoch) have height 0.
+        start may also be an array of start times, which are all swept in
+            the same pass: heights then has a column per start time.
+        prior is an array of heights computed earlier for the first nodes,
+            e.g. before the graph was extended with newer Patches. Only the
+            nodes after them are computed. Heights that depend on the
+            latest time, as with the scale of tHeight, cannot be reused.
+        Nodes are processed a level at a time, so each step is a handful of
+            array operations over all the edges of one level.
+        Returns an array of heights by node position, or a matrix of node
+            positions by start times.
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+
+    sweep = np.ndim(start) > 0
+    starts = None if start is None else np.atleast_1d(start)
+    n = len(graph)
+    height = np.zeros((n, 1 if starts is None else len(starts)))
+    first = 0
+    if prior is not None:
+        first = len(prior)
+        height[:first] = np.reshape(prior, (first, -1))
+    if not graph.number_of_edges():
+        return height if sweep else height[:, 0]
+
+    # Group the edges by the level of their source, then by source
+    src = graph.edgeSources()
+    level = levels(graph, first)
+    order = np.flatnonzero(src >= first)
+    order = order[np.argsort(level[src[order]], kind='mergesort')]
+    if not len(order):
+        return height if sweep else height[:, 0]
+    src = src[order]
+    dst = graph.indices[order]
+    term = graph.dist[order].astype(np.float64)
+    if scale is not None:
+        term *= scale[src]
+    term = term[:, None]
+    prob = graph.prob[order].astype(np.float64)[:, None]
+
+    # First edge of each source, and first source of each level
+    groups = np.flatnonzero(np.r_[True, src[1:] != src[:-1]])
+    groupLevel = level[src[groups]]
+    bounds = np.searchsorted(groupLevel, np.arange(groupLevel[-1] + 2))
+    groups = np.r_[groups, len(src)]
+
+    for l in xrange(len(bounds) - 1):
+        (g0, g1) = (bounds[l], bounds[l + 1])
+        if g0 == g1:
+            continue
+        (e0, e1) = (groups[g0], groups[g1])
+        values = (height[dst[e0:e1]] + term[e0:e1]) * prob[e0:e1]
+        nodes = src[groups[g0:g1]]
+        height[nodes] = np.add.reduceat(values, groups[g0:g1] - e0, axis=0)
+
+        if starts is not None:
+            early = ts.before(graph.time[nodes][:, None], starts)
+            height[nodes] = np.where(early, 0, height[nodes])
+
+    return height if sweep else height[:, 0]
+
+
+
+
+def _prior(graph, prior):
+    """
+        Returns the heights of a dictionary from an earlier metric of graph
+            as an array by node position, for heights to start from
+    """
+    if prior is None:
+        return None
+    return np.array([prior[n] for n in graph.nodeIds[:len(prior)].tolist()])
+
+
 
-# in minutes
-MONTH=43200
-YEAR=525600
 
 def tHeight(graph):
     """
         Returns a dictionary of the vertices and their weighted heights 
             from the first vertices at or after startDate.
     """
-    nodeList = nx.topological_sort(graph, reverse = True)
-    heightDict = {}
-    stime=graph.node[0]['time']
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+    return dict(zip(graph.nodes(), heights(graph, _decay(graph)).tolist()))
+
+def _decay(graph, lowpercent=DECAY_LOW):
+    """
+        The weights of the nodes of a CSRGraph for tHeight
+    """
     # Might need to redefine end time. Really should be date of download.
-    etime=graph.node[graph.nodes()[-1]]['time']
-    #T=ts.time_diff(stime, etime)
-
-    for node in nodeList:
-        height = 0
-        for (src, dst, prob) in graph.out_edges_iter(node, data='prob'):
-            if type(dst) != int:
-                dst = int(dst.decode("utf-8"))
-                src = int(src.decode("utf-8"))
-            date=graph.node[src]['time']
-            #t=ts.time_diff(date, etime)/T
-            scale=sigmoid(date, etime)
-            height += (heightDict[dst]+scale*graph.edge[src][dst]['dist'])*prob 
-
-        if type(node)!=int:
-            node = int(node.decode("utf-8"))
-        heightDict[node]= height
-
-    return heightDict
+    etime=graph.time[-1]
+    return ts.decay(ts.minute_diff(graph.time, etime), lowpercent)
 
 def sigmoid(date, etime):
     """
+        The weight of an edit at minute date, seen from minute etime. 
+            ts.decay does the same for arrays.
     """
     lowpercent=0.01
-    diff=ts.time_diff(date, etime)
-    if diff<MONTH:
+    diff=etime-date
+    if diff<ts.MONTH:
         s=1.0
-    elif diff<YEAR:
-        s= 1- float(diff-MONTH)/(YEAR-MONTH)
+    elif diff<ts.YEAR:
+        s= 1- float(diff-ts.MONTH)/(ts.YEAR-ts.MONTH)
         if s<lowpercent:
             s=lowpercent
     else:
@@ -60,75 +191,429 @@ def sigmoid(date, etime):
 
 
 
-def getAllHeights(graph):
+def getAllHeights(graph, prior=None):
     """
         Returns a dictionary of the vertices and their weighted heights 
             from the first vertex
+        prior is the result for an earlier version of graph, whose heights
+            are kept
     """     
-    nodeList = nx.topological_sort(graph, reverse = True)
-    heightDict = {}
-    for node in nodeList:
-        height = 0
-        for (src, dst, prob) in graph.out_edges_iter(node, data='prob'):
-            if type(dst) != int:
-                dst = int(dst.decode("utf-8"))
-                src = int(src.decode("utf-8")) 
-            height += (heightDict[dst]+graph.edge[src][dst]['dist'])*prob
-
-        if type(node)!=int:
-            node = int(node.decode("utf-8"))
-        heightDict[node]= height
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+    return dict(zip(graph.nodes(),
+                    heights(graph, prior=_prior(graph, prior)).tolist()))
 
-    return heightDict
 
 
 
-
-def getHeight(graph, startDate):
+def getHeight(graph, startDate, prior=None):
     """
         Returns a dictionary of the vertices and their weighted heights 
             from the first vertices at or after startDate.
+        prior is the result for an earlier version of graph with the same
+            startDate, whose heights are kept
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+    start=ts.string2minute(startDate)
+    return dict(zip(graph.nodes(), heights(graph, start=start,
+                                           prior=_prior(graph, prior)).tolist()))
+
+
+
+
+def getHeights(graph, startDates, prior=None):
+    """
+        Returns a dictionary of each of startDates and the dictionary of
+            vertices and heights getHeight gives for it, from one pass over
+            the graph
+        prior is the result for an earlier version of graph with the same
+            startDates, whose heights are kept
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+    starts = np.array([ts.string2minute(date) for date in startDates],
+                      dtype=np.int64)
+    if prior is not None:
+        prior = np.column_stack([_prior(graph, prior[date])
+                                 for date in startDates])
+    height = heights(graph, start=starts, prior=prior)
+    nodes = graph.nodes()
+    return dict((date, dict(zip(nodes, height[:, i].tolist())))
+                for (i, date) in enumerate(startDates))
+
+
+
+
+def provRanks(graph, weighted=False, prior=None, tol=PROVRANK_TOL,
+              maxIter=PROVRANK_ITER):
+    """
+        The ProvRank engine behind provRank and weightedProvRank.
+        Every iteration, each node keeps its score and pushes it along each
+            of its out-edges, times the edge prob if weighted, while nodes
+            without out-edges spread theirs over all nodes. Scores are then
+            normalized to sum to 1.
+        prior is an array of scores by node position to start from, e.g.
+            those of an earlier version of graph; the nodes it does not
+            cover start at the mean score. Iterations stop once no score
+            changes by more than tol, or after maxIter.
+        Returns an array of scores by node position.
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+
+    n = len(graph)
+    if not n:
+        return np.zeros(0)
+    weight = graph.prob.astype(np.float64) if weighted \
+        else np.ones(graph.number_of_edges())
+    push = sparse.csr_matrix((weight, (graph.indices, graph.edgeSources())),
+                             shape=(n, n))
+    dangling = np.diff(graph.indptr) == 0
+
+    score = np.empty(n)
+    score.fill(1.0/n)
+    if prior is not None and len(prior):
+        score[:len(prior)] = prior
+        score[len(prior):] = np.mean(prior)
+        score /= score.sum()
+
+    for i in xrange(maxIter):
+        last = score
+        score = last+push.dot(last)+last[dangling].sum()/n
+        score /= score.sum()
+        if np.abs(score-last).max() <= tol:
+            break
+    return score
+
+
+
+
+def provRank(graph, prior=None):
+    """
+        Returns a dictionary of the vertices and their ProvRank
+        prior is the result for an earlier version of graph, to start from
+    """
+    print "Computing ProvRank . . ."
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+    return dict(zip(graph.nodes(),
+                    provRanks(graph, prior=_prior(graph, prior)).tolist()))
+
+
+
+
+def weightedProvRank(graph, prior=None):
+    """
+        Returns a dictionary of the vertices and their ProvRank, with the
+            score pushed along each edge weighted by its prob
+        prior is the result for an earlier version of graph, to start from
+    """
+    print "Computing ProvRank . . ."
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+    return dict(zip(graph.nodes(), provRanks(graph, True,
+                                             _prior(graph, prior)).tolist()))
+
+
+
+
+def subRanks(graph, approximate=False, memory=SUBRANK_MEMORY,
+             precision=SUBRANK_PRECISION):
+    """
+        The SubRank engine behind subRank. The SubRank of a node is the
+            fraction of all nodes that are it or reach it along edges, i.e.
+            the node and the edits that build on it.
+        Every node holds the set of nodes that reach it, as a row of bits
+            packed in uint64 words. Going down the levels of the graph, a
+            node ORs in the rows of the nodes with edges into it, which are
+            all on higher levels. The bits are taken a block of nodes at a
+            time, so the rows never take more than memory bytes.
+        If approximate, every node holds HyperLogLog registers, 2**precision
+            bytes, merged by maximum instead, and SubRank is estimated from
+            them in one pass: for graphs too big for the exact one.
+        Returns an array of SubRanks by node position.
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+
+    n = len(graph)
+    if not n:
+        return np.zeros(0)
+
+    # Group the edges by the level of their target, highest first, then by
+    #   target
+    level = levels(graph)
+    src = graph.edgeSources()
+    dst = graph.indices
+    order = np.lexsort((dst, -level[dst]))
+    (src, dst) = (src[order], dst[order])
+    groups = np.flatnonzero(np.r_[True, dst[1:] != dst[:-1]]) \
+        if len(dst) else np.zeros(0, dtype=np.int64)
+    groupLevel = level[dst[groups]]
+    bounds = np.r_[np.flatnonzero(np.r_[True, groupLevel[1:] != groupLevel[:-1]]),
+                   len(groups)] if len(groups) else np.zeros(1, dtype=np.int64)
+    groups = np.r_[groups, len(src)]
+
+    if approximate:
+        rows = _hllRows(graph.nodeIds, precision)
+        _closure(rows, src, dst, groups, bounds, np.maximum, memory)
+        return _hllCount(rows)/n
+
+    # Only nodes on lower levels than a node can be reached from it, so a
+    #   block skips the levels above its own and the rows there
+    boundLevel = groupLevel[bounds[:-1]]
+    words = max(1, min((n+63)//64, memory//(8*n)))
+    rows = np.empty((n, words), dtype=np.uint64)
+    count = np.zeros(n, dtype=np.int64)
+    for first in xrange(0, n, 64*words):
+        nodes = np.arange(first, min(first+64*words, n))
+        top = level[nodes].max()
+        rows.fill(0)
+        bit = nodes-first
+        rows[nodes, bit//64] = np.left_shift(np.uint64(1),
+                                             (bit % 64).astype(np.uint64))
+        start = np.searchsorted(-boundLevel, -top, side='right')
+        _closure(rows, src, dst, groups, bounds[start:], np.bitwise_or, memory)
+        live = np.flatnonzero(level <= top)
+        for k in xrange(0, len(live), 1 << 14):
+            reached = live[k:k+(1 << 14)]
+            count[reached] += _POPCOUNT[rows[reached].view(np.uint8)].sum(
+                axis=1, dtype=np.int64)
+    return count/float(n)
+
+
+
+
+def _closure(rows, src, dst, groups, bounds, merge, memory):
     """
-    startDate=ts.string2date(startDate)
-    nodeList = nx.topological_sort(graph, reverse = True)
-    heightDict = {}
-    for node in nodeList:
-        height = 0
-        for (src, dst, prob) in graph.out_edges_iter(node, data='prob'):
-            if type(dst) != int:
-                dst = int(dst.decode("utf-8"))
-                src = int(src.decode("utf-8"))
-            date=graph.node[src]['time']
-            date=ts.ts2date(date)
-            if date < startDate:
-                height=0
-            else:
-                height += (heightDict[dst]+graph.edge[src][dst]['dist'])*prob 
+        Merges into the row of every edge target the rows of its sources, a
+            level at a time, with at most memory bytes of source rows at once
+    """
+    limit = max(1, memory//rows[0].nbytes)
+    for l in xrange(len(bounds)-1):
+        (g, g1) = (bounds[l], bounds[l+1])
+        while g < g1:
+            # Whole targets only, as many as fit in limit edges
+            g2 = min(g1, max(g+1, np.searchsorted(groups, groups[g]+limit,
+                                                  side='right')-1))
+            (e0, e1) = (groups[g], groups[g2])
+            merged = merge.reduceat(rows[src[e0:e1]], groups[g:g2]-e0, axis=0)
+            targets = dst[groups[g:g2]]
+            rows[targets] = merge(rows[targets], merged)
+            g = g2
+
+
 
-        if type(node)!=int:
-            node = int(node.decode("utf-8"))
-        heightDict[node]= height
 
-    return heightDict
+_POPCOUNT = np.array([bin(i).count("1") for i in xrange(256)], dtype=np.uint8)
 
 
 
 
-def wiki2color(title, remove, new, allrevs, startDate, shade, metricName):
+def _hllRows(ids, precision):
     """
-        Produces a heatmap of the metric height over the most recent revision.
+        Returns the HyperLogLog registers of the sets {id} for each id: the
+            register picked by the top precision bits of a hash of id holds
+            the position of the first 1 bit in the rest of them
+    """
+    h = np.asarray(ids).astype(np.uint64)
+    # splitmix64
+    with np.errstate(over='ignore'):
+        h = h+np.uint64(0x9E3779B97F4A7C15)
+        h = (h ^ (h >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+        h = (h ^ (h >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+        h = h ^ (h >> np.uint64(31))
+    register = (h >> np.uint64(64-precision)).astype(np.int64)
+    rest = h & np.uint64((1 << (64-precision))-1)
+    powers = np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))
+    rank = 64-precision-np.searchsorted(powers, rest, side='right')+1
+
+    rows = np.zeros((len(h), 1 << precision), dtype=np.uint8)
+    rows[np.arange(len(h)), register] = rank
+    return rows
+
+
+
+
+def _hllCount(rows):
+    """
+        Returns the estimated size of the set of each row of HyperLogLog
+            registers
+    """
+    m = rows.shape[1]
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213/(1+1.079/m))
+    inverse = 2.0**-np.arange(66)
+    estimate = np.empty(len(rows))
+    for k in xrange(0, len(rows), 1 << 14):
+        block = rows[k:k+(1 << 14)]
+        raw = alpha*m*m/inverse[block].sum(axis=1)
+        zeros = (block == 0).sum(axis=1)
+        small = (raw <= 2.5*m) & (zeros > 0)
+        raw[small] = m*np.log(float(m)/zeros[small])
+        estimate[k:k+(1 << 14)] = raw
+    return estimate
+
+
+
+
+def subRank(graph, approximate=False):
     """
-    (graph, content, model) = w2g.wiki2graph(title, remove, new)
-    if allrevs:
-       metricDict=tHeight(graph)
-       #metricDict=getAllHeights(graph)
+        Returns a dictionary of the vertices and their SubRank, estimated
+            with HyperLogLog if approximate
+    """
+    print "Computing SubRank . . ."
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.fromDiGraph(graph)
+    return dict(zip(graph.nodes(), subRanks(graph, approximate).tolist()))
+
+
+
+
+def cachedScores(graph, fingerprint, remove, metric, compute, **params):
+    """
+        Returns the scores by node position of metric with params on graph,
+            whose fingerprint is given, from metricCache if they are there.
+            Otherwise they are compute()d and cached.
+    """
+    key = metricCache.key(fingerprint, remove, metric, **params)
+    cached = metricCache.load(key)
+    if cached is not None:
+        print "Reading cached "+metric+" . . ."
+        return cached[1]
+    scores = compute()
+    metricCache.save(key, graph.nodeIds, scores)
+    return scores
+
+
+
+
+def cachedHeights(graph, fingerprint, remove, startDates, previous=None):
+    """
+        Returns a dictionary of each of startDates and the heights by node
+            position from it, as getHeights gives them. Heights missing
+            from metricCache are computed in one pass and cached.
+        previous is the fingerprint of the graph before an update, which
+            graph starts with (see startsWith): its cached heights are the
+            prior of the heights of graph, and only the new nodes are
+            computed.
+    """
+    starts = dict((date, ts.string2minute(date)) for date in startDates)
+    keys = dict((date, metricCache.key(fingerprint, remove, 'height',
+                                       start=starts[date]))
+                for date in startDates)
+    scores = {}
+    for date in startDates:
+        cached = metricCache.load(keys[date])
+        if cached is not None:
+            scores[date] = cached[1]
+
+    missing = [date for date in startDates if date not in scores]
+    if len(missing) < len(startDates):
+        print "Reading cached height . . ."
+    priors = {}
+    if previous is not None:
+        for date in missing:
+            cached = metricCache.load(metricCache.key(previous, remove, 'height',
+                                                      start=starts[date]))
+            if cached is not None:
+                priors[date] = cached[1]
+    if priors:
+        print "Reading height from before the update . . ."
+
+    # Dates with a prior and dates without are computed in a pass each
+    for group in ([date for date in missing if date in priors],
+                  [date for date in missing if date not in priors]):
+        if not group:
+            continue
+        prior = None
+        if group[0] in priors:
+            prior = np.column_stack([priors[date] for date in group])
+        height = heights(graph, start=np.array([starts[date] for date in group],
+                                               dtype=np.int64), prior=prior)
+        for (i, date) in enumerate(group):
+            scores[date] = height[:, i]
+            metricCache.save(keys[date], graph.nodeIds, scores[date])
+    return scores
+
+
+
+
+def startsWith(graph, previous):
+    """
+        Returns the fingerprint of previous, the (fingerprint, number of nodes)
+            of the graph before an update, if graph starts with that graph,
+            else None. Applying the model again, e.g. after a bot revert,
+            may renumber the Patches.
+    """
+    if previous is None:
+        return None
+    (fingerprint, m) = previous
+    if m > len(graph) or modelBundle.fingerprint(graph.head(m)) != fingerprint:
+        return None
+    return fingerprint
+
+
+
+
+def wiki2color(title, remove, new, allrevs, startDate, shade, metricName,
+               update=False, metric='height'):
+    """
+        Produces a heatmap of a metric over the most recent revision: the
+            height, the ProvRank or weighted ProvRank, or the SubRank of the
+            edits.
+        startDate may be a list of start dates, which are all computed at
+            once, with a heatmap each: the date is added to metricName.
+        Scores are cached by metricCache, keyed by the graph and the
+            metric, and the heatmaps are colored from the cached arrays.
+            The fingerprint of the graph is read from its bundle, which
+            keeps it, so that a cache hit does not hash the graph.
+        With update, the cached heights of the graph before it are reused,
+            and only the heights of the new nodes are computed.
+    """
+    previous=None
+    if update and not new and modelBundle.exists(title, remove):
+        bundle=modelBundle.Bundle(title, remove)
+        previous=(bundle.fingerprint, len(bundle.arrays['nodeIds']))
+    (graph, content, model) = w2g.wiki2graph(title, remove, new, update=update)
+    if modelBundle.exists(title, remove):
+        fingerprint=modelBundle.Bundle(title, remove).fingerprint
     else:
-        metricDict=getHeight(graph, startDate)
-   
-    if shade:
-        m2c.metric2shades(title, remove, metricName, metricDict)
+        fingerprint=modelBundle.fingerprint(graph)
+    if previous is not None and previous[0] == fingerprint:
+        previous=None   # Nothing new: the scores are cached under fingerprint
+    previous=startsWith(graph, previous)
+    if metric in ('provrank', 'wprovrank'):
+        weighted=metric == 'wprovrank'
+        scores={None: cachedScores(graph, fingerprint, remove, metric,
+                                   lambda: provRanks(graph, weighted),
+                                   tol=PROVRANK_TOL, maxIter=PROVRANK_ITER)}
+    elif metric == 'subrank':
+        scores={None: cachedScores(graph, fingerprint, remove, metric,
+                                   lambda: subRanks(graph))}
+    elif metric == 'approxsubrank':
+        scores={None: cachedScores(graph, fingerprint, remove, metric,
+                                   lambda: subRanks(graph, True),
+                                   precision=SUBRANK_PRECISION)}
+    elif allrevs:
+        scores={None: cachedScores(graph, fingerprint, remove, 'theight',
+                                   lambda: heights(graph, _decay(graph)),
+                                   lowpercent=DECAY_LOW, month=ts.MONTH,
+                                   year=ts.YEAR)}
+        #scores={None: heights(graph)}
+    elif isinstance(startDate, basestring):
+        scores={None: cachedHeights(graph, fingerprint, remove,
+                                    [startDate], previous)[startDate]}
     else:
-        m2c.metric2color(title, remove, metricName, metricDict)
+        scores=cachedHeights(graph, fingerprint, remove, startDate, previous)
+
+    for (date, score) in sorted(scores.items()):
+        name=metricName if date is None else metricName+"_"+date
+        if shade:
+            m2c.metric2shades(title, remove, name, (graph.nodeIds, score))
+        else:
+            m2c.metric2color(title, remove, name, (graph.nodeIds, score))
+    return scores
 
 
 
@@ -149,16 +634,35 @@ def parse_args():
                       action='store_true', dest='allrevs', default=False,
                       help='include all revisions')
     parser.add_argument('-s', '--start',
-                      dest='start', nargs=1, default='1-1-2001',
-                      help='start date for height calculation')
+                      dest='start', action='append', default=None,
+                      help='start date for height calculation, repeat for '
+                           'several (default 1-1-2001)')
+    parser.add_argument('-sw', '--sweep',
+                      dest='sweep', nargs=3, metavar=('FIRST', 'LAST', 'DAYS'),
+                      help='start dates from FIRST to LAST, every DAYS days')
     parser.add_argument('-sh', '--shade',
                       action='store_true', dest='shade', default=False,
                       help='color by score instead of percentile')
+    parser.add_argument('-u', '--update',
+                      action='store_true', dest='update', default=False,
+                      help='download and apply only new revisions')
+    parser.add_argument('-m', '--metric',
+                      dest='metric', choices=METRICS, default='height',
+                      help='metric to color by')
     parser.add_argument('metricName', nargs=1)
 
     n=parser.parse_args()
 
-    wiki2color(n.title[0], n.remove, n.new, n.allrevs, n.start[0], n.shade, n.metricName[0])
+    if n.sweep:
+        start=ts.dateRange(n.sweep[0], n.sweep[1], int(n.sweep[2]))
+    elif n.start is None:
+        start='1-1-2001'
+    elif len(n.start) > 1:
+        start=n.start
+    else:
+        start=n.start[0]
+    wiki2color(n.title[0], n.remove, n.new, n.allrevs, start, n.shade,
+               n.metricName[0], n.update, n.metric)
 
 
 if __name__ == '__main__':
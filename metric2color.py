@@ -1,7 +1,10 @@
 #!/usr/bin/python
 
+import itertools
 import os
+import numpy as np
 import wiki2graph as w2g
+import modelBundle
 #import husl as col
 import codecs
 
@@ -16,6 +19,21 @@ NUMHUE=180
 SATURATION = 100
 LIGHTNESS=50
 
+# Bucket edges for percentileColors, as fractions of the edits by
+#   decreasing score or as a function of their number giving the ranks,
+#   and the colors of the buckets they make. TENTHS keeps the edges of the
+#   old colorPercentile: multiples of int(n*0.1), which may fall short of
+#   int(n*0.3) and so on.
+TENTHS=lambda n: int(n*0.1)*np.arange(1, 6)
+FIFTHS=[0.2, 0.4, 0.6, 0.8]
+SPREAD=[0.01, 0.05, 0.15, 0.25, 0.5, 0.75, 0.85, 0.95, 0.99]
+COLOR_NAMES=["darkred", "red", "mediumred", "lightred", "pink", "white"]
+BCOLOR_NAMES=["darkred", "red", "mediumred", "lightred", "pink",
+              "lilac", "lightblue", "mediumblue", "blue", "darkblue"]
+HUSL_NAMES=["c0", "c1", "c2", "c3", "c4"]
+MARKUP_NAMES=["#990000", "#cc0000", "#ff4d4d", "#ff9999", "#ffcccc",
+              "#ccccff", "#9999ff", "#4d4dff", "#0000cc", "#000099"]
+
 """def getHue(model, metricDict):
 
     a=[(metricDict[x[1]], x[1]) for x in model]
@@ -37,369 +55,161 @@ def metric2HUSL(title, remove, metricName, metricDict):
             file in heatmaps, based on the percentile of the text according
             to metricDict.
     """
-    content = w2g.readContent(title, remove)
-    model = w2g.readModel(title, remove)
+    (content, words, model) = readHeatmap(title, remove)
     colors=getHue(model, metricDict)
-    writeHues(title, remove, metricName, model, content, colors)
+    writeHues(title, remove, metricName, model, content, colors, words)
 
 
 
-def writeHues(title, remove, metricName, model, content, colors):
+def writeHues(title, remove, metricName, model, content, colors,
+              words=None):
     """
         Writes the most recent revision to a .html file based on the shades in the
             dictionary, colors.
         metricName will be part of the file title
+        words are the word offsets of content, see renderHeatmap.
     """
-    print "Writing heat map . . ."
-
-    if not os.path.isdir('heatmaps'):
-        os.mkdir('heatmaps')
-    
-    if remove:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+"_rem.html", "w")
-    else:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+".html", "w")
-
-    # Write style sheet
-    colorFile.write("<!DOCTYPE html>\n<html>\n<head>\n<style>\n")
-    colorFile.write("p {\n\tcolor: black;\n}\n")
-
-    # Write content
-    colorFile.write("</style><body>\n")
-
-    content=content.split("\n")
-    content=[line.split() for line in content]
-
-    pos=0
-    dif = model[pos][0]
-    color=colors[model[pos][1]]
-    
-    for line in content:
-        current = "<p><span style=background-color:"+color+";>"
-        for i in range(len(line)):
-            if dif == 0:
-                while dif==0:
-                    pos+=1
-                    color=colors[model[pos][1]]
-                    dif = model[pos][0] - model[pos-1][0]
-                current+="</span><span style=background-color:"+color+";>"
-
-            current+=line[i]+ " "
-            dif-=1
-        current+="</span></p>\n"
-        colorFile.write(current)
-
-    colorFile.write("</body>\n</html>")
-    colorFile.close()
+    renderHeatmap(title, remove, metricName, HUES, model, content, colors,
+                  words)
 
 
 
 
 
 
-def colorPercentile(model, metricDict):
+def percentileColors(model, metric, edges, names):
     """
-        Assigns edit ids in model to colors by percentile based on
-            metricDict. Returns a dictionary of colors.
+        Assigns edit ids in model to colors by percentile based on metric,
+            a dictionary of scores by edit id, an array of scores aligned
+            with the spans of model, or the edit ids and scores of
+            metricCache.
+        Edits are ranked by decreasing score, and edges are the fractions
+            of them at which each color gives way to the next, or a function
+            of the number of edits that returns those ranks: names has one
+            more color than edges. Returns a dictionary of colors.
     """
     print "Assigning colors . . ."
-    
-    # Sort by decreasing scores
-    a=[(metricDict[x[1]], x[1]) for x in model]
-    s=set(a)
-    a=sorted(list(s), reverse=True)
 
-    # Assign colors to nodes
-    length=len(a)
+    (pids, scores) = _scores(model, metric)
+    classes = buckets(scores, edges, pids)
+    return dict(zip(pids.tolist(), [names[c] for c in classes.tolist()]))
+
 
-    percentLen = int(length*0.1)
 
-    colors = {}
 
-    # Top 1%
-    for i in range(percentLen):
-        colors[a[i][1]]="darkred"
-    # 1-5
-    for i in range(percentLen, percentLen*2):
-        colors[a[i][1]]="red"
-    # 5-10
-    for i in range(percentLen*2, percentLen*3):
-        colors[a[i][1]]="mediumred"
-    # 10-15
-    for i in range(percentLen*3, percentLen*4):
-        colors[a[i][1]]="lightred"
-    # 15-25
-    for i in range(percentLen*4, percentLen*5):
-        colors[a[i][1]]="pink"
-    for i in range(percentLen*5,length):
-        colors[a[i][1]]="white"
-    
-    return colors
-
-
-
-    
-def writeColors(title, remove, metricName, model, content, colors):
+def buckets(scores, edges, ids=None):
     """
-        Writes the most recent revision to a .html file based on the dictionary
-            colors.
-        metricName will be part of the file title
+        Returns the bucket of every score: ranked by decreasing score, and
+            by decreasing ids among equal scores, the ranks from
+            int(n*edges[i-1]) up to int(n*edges[i]) are in bucket i. edges
+            may instead be a function of n that returns those ranks.
+        Only the scores at the edges are placed, with argpartition, and the
+            rest are bucketed against them with searchsorted, so the scores
+            are never fully sorted.
     """
-    print "Writing heat map . . ."
-
-    if not os.path.isdir('heatmaps'):
-        os.mkdir('heatmaps')
-    
-    if remove:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+"_rem.html", "w")
+    scores = np.asarray(scores, dtype=np.float64)
+    n = len(scores)
+    ids = np.arange(n) if ids is None else np.asarray(ids)
+    if callable(edges):
+        bounds = np.asarray(edges(n), dtype=np.int64)
     else:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+".html", "w")
-
-    # Write style sheet
-    colorFile.write("<!DOCTYPE html>\n<html>\n<head>\n<style/>\n")
-    colorFile.write(".white {\n\tbackground-color: white;\n\tcolor: black;\n}\n")
-    colorFile.write(".pink {\n\tbackground-color: #ffcccc;\n\tcolor: black;\n}\n")
-    colorFile.write(".lightred {\n\tbackground-color: #ff9999;\n\tcolor: black;\n}\n")
-    colorFile.write(".mediumred {\n\tbackground-color: #ff4d4d;\n\tcolor: black;\n}\n")
-    colorFile.write(".red {\n\tbackground-color: #cc0000;\n\tcolor: black;\n}\n")
-    colorFile.write(".darkred {\n\tbackground-color: #990000;\n\tcolor: black;}\n")
-    colorFile.write("</style>\n</head>\n")
-
-    # Write content
-    colorFile.write("<body>\n")
-
-    content=content.split("\n")
-    content=[line.split() for line in content]
-
-    pos=0
-    dif = model[pos][0]
-    color="white"
-    
-    for line in content:
-        current = "<p><span class="+color+">"
-        for i in range(len(line)):
-            if dif == 0:
-                while dif==0:
-                    pos+=1
-                    color=colors[model[pos][1]]
-                    dif = model[pos][0] - model[pos-1][0]
-                current+="</span><span class="+color+">"
-
-            current+=line[i]+ " "
-            dif-=1
-        current+="</span></p>\n"
-        colorFile.write(current)
-
-    colorFile.write("</body>\n</html>")
-    colorFile.close()
-
-
-
-
-def bcolorPercentile(model, metricDict):
+        bounds = (n*np.asarray(edges, dtype=np.float64)).astype(np.int64)
+    (inner, weight) = np.unique(bounds[(bounds > 0) & (bounds < n)],
+                                return_counts=True)
+
+    bucket = np.zeros(n, dtype=np.int64)
+    bucket += np.count_nonzero(bounds <= 0)
+    if not len(inner):
+        return bucket
+
+    # Scores past an edge are below the score ranked at it
+    key = -scores
+    edge = key[np.argpartition(key, inner)[inner]]
+    lo = np.searchsorted(edge, key, side='left')
+    hi = np.searchsorted(edge, key, side='right')
+    passed = np.r_[0, np.cumsum(weight)]
+    bucket += passed[lo]
+
+    # Ties with the score at an edge fill up to it by decreasing ids
+    above = np.cumsum(np.bincount(hi, minlength=len(inner)+1))
+    tied = np.flatnonzero(hi > lo)
+    for j in np.unique(lo[tied]).tolist():
+        at = tied[lo[tied] == j]
+        for k in xrange(j, hi[at[0]]):
+            ahead = inner[k]-above[k]
+            past = at
+            if ahead:
+                cutoff = np.partition(ids[at], len(at)-ahead)[len(at)-ahead]
+                past = at[ids[at] < cutoff]
+            bucket[past] += weight[k]
+    return bucket
+
+
+
+
+def _scores(model, metric):
     """
-        Assigns edit ids in model to colors by percentile based on
-            metricDict. Returns a dictionary of colors.
+        Returns the distinct edit ids of model, increasing, and their scores
+            from metric, a dictionary by edit id, an array aligned with
+            the spans of model, or a pair of arrays of increasing edit ids
+            and their scores, as metricCache keeps them
     """
-    print "Assigning colors . . ."
-    
-    # Sort by decreasing scores
-    a=[(metricDict[x[1]], x[1]) for x in model]
-    s=set(a)
-    a=sorted(list(s), reverse=True)
-
-    # Assign colors to nodes
-    length=len(a)
-
-    colors = {}
-
-    # Top 1%
-    for i in range(int(length*0.01)):
-        colors[a[i][1]]="darkred"
-    # 1-5
-    for i in range(int(length*0.01), int(0.05*length)):
-        colors[a[i][1]]="red"
-    # 5-15
-    for i in range(int(length*0.05), int(length*0.15)):
-        colors[a[i][1]]="mediumred"
-    # 15-25
-    for i in range(int(length*0.15), int(length*0.25)):
-        colors[a[i][1]]="lightred"
-    # 25-50
-    for i in range(int(length*0.25), int(length*0.5)):
-        colors[a[i][1]]="pink"
-
-    # 50-75
-    for i in range(int(length*0.5), int(length*0.75)):
-        colors[a[i][1]]="lilac"
-    # 75-85
-    for i in range(int(length*0.75), int(length*0.85)):
-        colors[a[i][1]]="lightblue"
-    # 85-95
-    for i in range(int(length*0.85), int(length*0.95)):
-        colors[a[i][1]]="mediumblue"
-    # 95-99
-    for i in range(int(length*0.95), int(length*0.99)):
-        colors[a[i][1]]="blue"
-    # Bottom 1%
-    for i in range(int(length*0.99), length):
-        colors[a[i][1]]="darkblue"
-    
-    return colors
-
-
-
-    
-def bwriteColors(title, remove, metricName, model, content, colors):
+    pids = np.array([pid for (end, pid) in model], dtype=np.int64)
+    if isinstance(metric, tuple):
+        (ids, scores) = metric
+        pids = np.unique(pids)
+        at = np.minimum(np.searchsorted(ids, pids), len(ids)-1)
+        assert len(ids) and (ids[at] == pids).all(), \
+            "Scores do not cover the model."
+        return pids, np.asarray(scores, dtype=np.float64)[at]
+    if isinstance(metric, dict):
+        pids = np.unique(pids)
+        return pids, np.array([metric[pid] for pid in pids.tolist()],
+                              dtype=np.float64)
+    (pids, first) = np.unique(pids, return_index=True)
+    return pids, np.asarray(metric, dtype=np.float64)[first]
+
+
+
+
+def writeColors(title, remove, metricName, model, content, colors,
+                words=None):
     """
         Writes the most recent revision to a .html file based on the dictionary
             colors.
         metricName will be part of the file title
+        words are the word offsets of content, see renderHeatmap.
     """
-    print "Writing heat map . . ."
-
-    if not os.path.isdir('heatmaps'):
-        os.mkdir('heatmaps')
-    
-    if remove:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+"_rem.html", "w")
-    else:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+".html", "w")
-
-    # Write style sheet
-    colorFile.write("<!DOCTYPE html>\n<html>\n<head>\n<style/>\n")
-    colorFile.write(".pink {\n\tbackground-color: #ffcccc;\n\tcolor: black;\n}\n")
-    colorFile.write(".lightred {\n\tbackground-color: #ff9999;\n\tcolor: black;\n}\n")
-    colorFile.write(".mediumred {\n\tbackground-color: #ff4d4d;\n\tcolor: black;\n}\n")
-    colorFile.write(".red {\n\tbackground-color: #cc0000;\n\tcolor: black;\n}\n")
-    colorFile.write(".darkred {\n\tbackground-color: #990000;\n\tcolor: black;}\n")
-    colorFile.write(".lilac {\n\tbackground-color: #ccccff;\n\tcolor: black;\n}\n")
-    colorFile.write(".lightblue {\n\tbackground-color: #9999ff;\n\tcolor: black;\n}\n")
-    colorFile.write(".mediumblue {\n\tbackground-color: #4d4dff;\n\tcolor: black;\n}\n")
-    colorFile.write(".blue {\n\tbackground-color: #0000cc;\n\tcolor: black;\n}\n")
-    colorFile.write(".darkblue {\n\tbackground-color: #000099;\n\tcolor: black;}\n")
-    colorFile.write("</style>\n</head>\n")
-
-    # Write content
-    colorFile.write("<body>\n")
-
-    content=content.split("\n")
-    content=[line.split() for line in content]
-
-    pos=0
-    dif = model[pos][0]
-    color=colors[model[pos][1]]
-    
-    for line in content:
-        current = "<p><span class="+color+">"
-        for i in range(len(line)):
-            if dif == 0:
-                while dif==0:
-                    pos+=1
-                    color=colors[model[pos][1]]
-                    dif = model[pos][0] - model[pos-1][0]
-                current+="</span><span class="+color+">"
-
-            current+=line[i]+ " "
-            dif-=1
-        current+="</span></p>\n"
-        colorFile.write(current)
-
-    colorFile.write("</body>\n</html>")
-    colorFile.close()
+    renderHeatmap(title, remove, metricName, COLORS, model, content, colors,
+                  words)
 
 
 
 
-def HUSLPercentile(model, metricDict):
+def bwriteColors(title, remove, metricName, model, content, colors,
+                 words=None):
     """
-        Assigns edit ids in model to colors by percentile based on
-            metricDict. Returns a dictionary of colors.
+        Writes the most recent revision to a .html file based on the dictionary
+            colors.
+        metricName will be part of the file title
+        words are the word offsets of content, see renderHeatmap.
     """
-    print "Assigning colors . . ."
-    
-    # Sort by decreasing scores
-    a=[(metricDict[x[1]], x[1]) for x in model]
-    s=set(a)
-    a=sorted(list(s), reverse=True)
+    renderHeatmap(title, remove, metricName, BCOLORS, model, content, colors,
+                  words)
+
 
-    # Assign colors to nodes
-    length=len(a)
 
-    colors = {}
 
-    
-    for i in range(int(length*0.2)):
-        colors[a[i][1]]="c0"
- 
-    for i in range(int(length*0.2), int(0.4*length)):
-        colors[a[i][1]]="c1"
-   
-    for i in range(int(length*0.4), int(length*0.6)):
-        colors[a[i][1]]="c2"
-   
-    for i in range(int(length*0.6), int(length*0.8)):
-        colors[a[i][1]]="c3"
-  
-    for i in range(int(length*0.8), int(length)):
-        colors[a[i][1]]="c4"
-
-    
-    return colors
-
-def colorHUSL(title, remove, metricName, model, content, colors):
+def colorHUSL(title, remove, metricName, model, content, colors,
+              words=None):
     """
         Writes the most recent revision to a .html file based on the dictionary
             colors.
         metricName will be part of the file title
+        words are the word offsets of content, see renderHeatmap.
     """
-    print "Writing heat map . . ."
-
-    if not os.path.isdir('heatmaps'):
-        os.mkdir('heatmaps')
-    
-    if remove:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+"_rem.html", "w")
-    else:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+".html", "w")
-
-    # Write style sheet
-    colorFile.write("<!DOCTYPE html>\n<html>\n<head>\n<style/>\n")
-    colorFile.write(".c0 {\n\tbackground-color: #d7191c;\n\tcolor: black;\n}\n")
-    colorFile.write(".c1 {\n\tbackground-color: #fdae61;\n\tcolor: black;\n}\n")
-    colorFile.write(".c2 {\n\tbackground-color: #ffffbf;\n\tcolor: black;\n}\n")
-    colorFile.write(".c3 {\n\tbackground-color: #abdda4;\n\tcolor: black;\n}\n")
-    colorFile.write(".c4 {\n\tbackground-color: #2b83ba;\n\tcolor: black;}\n")
-    
-    colorFile.write("</style>\n</head>\n")
-
-    # Write content
-    colorFile.write("<body>\n")
-
-    content=content.split("\n")
-    content=[line.split() for line in content]
-
-    pos=0
-    dif = model[pos][0]
-    color=colors[model[pos][1]]
-    
-    for line in content:
-        current = "<p><span class="+color+">"
-        for i in range(len(line)):
-            if dif == 0:
-                while dif==0:
-                    pos+=1
-                    color=colors[model[pos][1]]
-                    dif = model[pos][0] - model[pos-1][0]
-                current+="</span><span class="+color+">"
-
-            current+=line[i]+ " "
-            dif-=1
-        current+="</span></p>\n"
-        colorFile.write(current)
-
-    colorFile.write("</body>\n</html>")
-    colorFile.close()
+    renderHeatmap(title, remove, metricName, HUSL, model, content, colors,
+                  words)
 
 
 def metric2color(title, remove, metricName, metricDict):
@@ -408,173 +218,53 @@ def metric2color(title, remove, metricName, metricDict):
             file in heatmaps, based on the percentile of the text according
             to metricDict.
     """
-    content = w2g.readContent(title, remove)
-    model = w2g.readModel(title, remove)
-    #colors=bcolorPercentile(model, metricDict)
+    (content, words, model) = readHeatmap(title, remove)
+    #colors=percentileColors(model, metricDict, SPREAD, BCOLOR_NAMES)
     #bwriteColors(title, remove, metricName, model, content, colors)
-    colors=HUSLPercentile(model, metricDict)
-    colorHUSL(title, remove, metricName, model, content, colors)
+    colors=percentileColors(model, metricDict, FIFTHS, HUSL_NAMES)
+    colorHUSL(title, remove, metricName, model, content, colors, words)
 
-def percentileMarkup(model, metricDict):
-    """
-    """
-    print "Assigning colors . . ."
-    
-    # Sort by decreasing scores
-    a=[(metricDict[x[1]], x[1]) for x in model]
-    s=set(a)
-    a=sorted(list(s), reverse=True)
 
-    # Assign colors to nodes
-    length=len(a)
 
-    colors = {}
 
-    # Top 1%
-    for i in range(int(length*0.01)):
-        colors[a[i][1]]="#990000"
-    # 1-5
-    for i in range(int(length*0.01), int(0.05*length)):
-        colors[a[i][1]]="#cc0000"
-    # 5-15
-    for i in range(int(length*0.05), int(length*0.15)):
-        colors[a[i][1]]="ff4d4d"
-    # 15-25
-    for i in range(int(length*0.15), int(length*0.25)):
-        colors[a[i][1]]="#ff9999"
-    # 25-50
-    for i in range(int(length*0.25), int(length*0.5)):
-        colors[a[i][1]]="#ffcccc"
-
-    # 50-75
-    for i in range(int(length*0.5), int(length*0.75)):
-        colors[a[i][1]]="#ccccff"
-    # 75-85
-    for i in range(int(length*0.75), int(length*0.85)):
-        colors[a[i][1]]="#9999ff"
-    # 85-95
-    for i in range(int(length*0.85), int(length*0.95)):
-        colors[a[i][1]]="#4d4dff"
-    # 95-99
-    for i in range(int(length*0.95), int(length*0.99)):
-        colors[a[i][1]]="#0000cc"
-    # Bottom 1%
-    for i in range(int(length*0.99), length):
-        colors[a[i][1]]="#000099"
-    
-    return colors
-
-
-
-def writeMarkup(title, remove, metricName, model, content, colors):
+def writeMarkup(title, remove, metricName, model, content, colors,
+                words=None):
     """
+        Writes the most recent revision as bare paragraphs, without a page
+            around them, based on the dictionary colors.
+        metricName will be part of the file title
+        words are the word offsets of content, see renderHeatmap.
     """
-    print "Writing heat map . . ."
-
-    if not os.path.isdir('heatmaps'):
-        os.mkdir('heatmaps')
-    
-    if remove:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+"_rem", "w")
-    else:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_"), "w")
-
-
-    content=content.split("\n")
-    content=[line.split() for line in content]
-
-    pos=0
-    dif = model[pos][0]
-    color=colors[model[pos][1]]
-    
-    for line in content:
-        current = "<p><span style=background-color:"+color+";>"
-        for i in range(len(line)):
-            if dif == 0:
-                while dif==0:
-                    pos+=1
-                    color=colors[model[pos][1]]
-                    dif = model[pos][0] - model[pos-1][0]
-                current+="</span><span style=background-color:"+color+";>"
-
-            current+=line[i]+ " "
-            dif-=1
-        current+="</span></p>\n"
-        colorFile.write(current)
-
-    colorFile.close()
+    renderHeatmap(title, remove, metricName, MARKUP, model, content, colors,
+                  words)
 
 
 
 def getShades(model, metricDict):
     """
         Assigns a position in the color range to edits in the model, based on
-            the scores in metricDict rather than percentile.
+            the scores in metricDict rather than percentile, in any of the
+            forms percentileColors takes.
         Returns a dictionary of colors.
     """
-    maxScore=max([metricDict[x[1]] for x in model])
-    colors={}
+    (pids, scores) = _scores(model, metricDict)
     #rbg(r,b,g) From 0-255
+    shades = (scores/scores.max()*NUMSHADES).astype(np.int64)
+    return dict(zip(pids.tolist(), shades.tolist()))
 
-    for (end, edit) in model:
-        color=metricDict[edit]/maxScore
-        colors[edit]=int(color*NUMSHADES)
-
-    return colors
 
 
 
-
-def writeShades(title, remove, metricName, model, content, colors):
+def writeShades(title, remove, metricName, model, content, colors,
+                words=None):
     """
         Writes the most recent revision to a .html file based on the shades in the
             dictionary, colors.
         metricName will be part of the file title
+        words are the word offsets of content, see renderHeatmap.
     """
-    print "Writing heat map . . ."
-
-    if not os.path.isdir('heatmaps'):
-        os.mkdir('heatmaps')
-    
-    if remove:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+"_rem.html", "w")
-    else:
-        colorFile = open("heatmaps/"+(metricName+"_"+title).replace(" ", "_")+".html", "w")
-
-    # Write style sheet
-    colorFile.write("<!DOCTYPE html>\n<html>\n<head>\n<style>\n")
-    colorFile.write("p {\n\tcolor: black;\n}\n")
-
-    # Write content
-    colorFile.write("</style><body>\n")
-
-    content=content.split("\n")
-    content=[line.split() for line in content]
-
-    pos=0
-    dif = model[pos][0]
-    color=getrgb(colors[model[pos][1]])
-    # colorValues = color.partition('(')[-1].rpartition(')')[0]
-    # valuesList = colorValues.split(',')
-    # adjustedColor = col.rgb_to_husl(int(valuesList[0]), int(valuesList[1]), int(valuesList[2]))
-    
-    for line in content:
-        current = "<p><span style=background-color:"+color+";>"
-        for i in range(len(line)):
-            if dif == 0:
-                while dif==0:
-                    pos+=1
-                    color=getrgb(colors[model[pos][1]])
-                    dif = model[pos][0] - model[pos-1][0]
-                current+="</span><span style=background-color:"+color+";>"
-
-            current+=line[i]+ " "
-            dif-=1
-        current+="</span></p>\n"
-        colorFile.write(current)
-
-    colorFile.write("</body>\n</html>")
-    colorFile.close()
+    renderHeatmap(title, remove, metricName, SHADES, model, content, colors,
+                  words)
 
 
 
@@ -621,7 +311,141 @@ def metric2shades(title, remove, metricName, metricDict):
             file in heatmaps, based on the score in metricDict, rather
             than percentile.
     """
-    content = w2g.readContent(title, remove)
-    model = w2g.readModel(title, remove)
+    (content, words, model) = readHeatmap(title, remove)
     colors=getShades(model, metricDict)
-    writeShades(title, remove, metricName, model, content, colors)
+    writeShades(title, remove, metricName, model, content, colors, words)
+
+
+
+
+class Scheme(object):
+    """
+        How a heatmap shows colors: head and tail wrap the paragraphs, span
+            is the markup that opens a span of a color, with the color as
+            color(value) formats it, and extension ends the file name.
+    """
+
+    def __init__(self, head, span, tail="</body>\n</html>", extension=".html",
+                 color=str):
+        self.head = head
+        self.span = span
+        self.tail = tail
+        self.extension = extension
+        self.color = color
+
+
+# Style sheets of class based schemes
+_STYLE = "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n<style/>\n"
+_CLASS = ".%s {\n\tbackground-color: %s;\n\tcolor: black;\n}\n"
+_END_STYLE = "</style>\n</head>\n<body>\n"
+_PLAIN = "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n<style>\n" \
+         "p {\n\tcolor: black;\n}\n</style><body>\n"
+
+def _classes(pairs):
+    return _STYLE+''.join(_CLASS % pair for pair in pairs)+_END_STYLE
+
+COLORS = Scheme(_classes([("white", "white"), ("pink", "#ffcccc"),
+                          ("lightred", "#ff9999"), ("mediumred", "#ff4d4d"),
+                          ("red", "#cc0000"), ("darkred", "#990000")]),
+                "<span class=%s>")
+BCOLORS = Scheme(_classes([("pink", "#ffcccc"), ("lightred", "#ff9999"),
+                           ("mediumred", "#ff4d4d"), ("red", "#cc0000"),
+                           ("darkred", "#990000"), ("lilac", "#ccccff"),
+                           ("lightblue", "#9999ff"), ("mediumblue", "#4d4dff"),
+                           ("blue", "#0000cc"), ("darkblue", "#000099")]),
+                 "<span class=%s>")
+HUSL = Scheme(_classes([("c0", "#d7191c"), ("c1", "#fdae61"), ("c2", "#ffffbf"),
+                        ("c3", "#abdda4"), ("c4", "#2b83ba")]),
+              "<span class=%s>")
+HUES = Scheme(_PLAIN, "<span style=background-color:%s;>")
+MARKUP = Scheme("", "<span style=background-color:%s;>", tail="", extension="")
+SHADES = Scheme(_PLAIN, "<span style=background-color:%s;>", color=getrgb)
+
+BUFFER = 1 << 16   # Bytes of a heatmap buffered before they are written
+RUNS = 4096   # Runs of words joined at a time
+
+
+
+
+def readHeatmap(title, remove):
+    """
+        Returns the latest content of title, the start and end offsets of its
+            words and the spans of its PatchModel. The content is UTF-8
+            encoded and the offsets are read from its bundle if there is
+            one; otherwise the offsets are None.
+    """
+    words = None
+    if modelBundle.exists(title, remove):
+        bundle = modelBundle.Bundle(title, remove)
+        (content, words) = (bundle.content(), bundle.words())
+    else:
+        content = w2g.readContent(title, remove)
+    return content, words, w2g.readModel(title, remove)
+
+
+
+
+def renderHeatmap(title, remove, metricName, scheme, model, content, colors,
+                  words=None):
+    """
+        The engine behind the heatmap writers. Writes content, a paragraph
+            per line, to a file in heatmaps with each word colored by scheme
+            after colors[pid] of the Patch that owns it in model.
+        words are the start and end byte offsets of the words of content, as
+            a bundle keeps them; they are found with modelBundle.wordOffsets
+            if they are not given.
+        Neighboring words of the same color in a paragraph share a span, and
+            the markup is streamed out a run of words at a time.
+    """
+    print "Writing heat map . . ."
+
+    if not os.path.isdir('heatmaps'):
+        os.mkdir('heatmaps')
+    path = "heatmaps/"+(metricName+"_"+title).replace(" ", "_")
+    if remove:
+        path += "_rem"
+    path += scheme.extension
+
+    # The words, and the line and the color of every word
+    if words is None:
+        words = modelBundle.wordOffsets(content)
+    (starts, ends) = words
+    n = len(starts)
+    newlines = np.flatnonzero(np.frombuffer(content, dtype=np.uint8) == 10)
+    line = np.searchsorted(newlines, starts)
+    text = [content[start:end]
+            for (start, end) in itertools.izip(starts.tolist(), ends.tolist())]
+    model = np.array(model, dtype=np.int64).reshape(-1, 2)
+    assert not n or (len(model) and model[-1, 0] >= n), \
+        "Model does not cover the content."
+    values = {}
+    codes = np.array([values.setdefault(colors[pid], len(values))
+                      for pid in model[:, 1].tolist()], dtype=np.int64)
+    code = np.repeat(codes, np.diff(np.r_[0, model[:, 0]]))[:n]
+
+    # Runs of words of one color on one line
+    first = np.ones(n, dtype=bool)
+    first[1:] = (code[1:] != code[:-1]) | (line[1:] != line[:-1])
+    runs = np.flatnonzero(first)
+    runEnds = np.r_[runs[1:], n]
+    breaks = np.diff(np.r_[0, line[runs]])
+
+    spans = [None]*len(values)
+    for (value, c) in values.items():
+        spans[c] = scheme.span % scheme.color(value)
+
+    # A run closes the paragraphs of the lines since the last one
+    (runs, runEnds) = (runs.tolist(), runEnds.tolist())
+    (breaks, codes) = (breaks.tolist(), code[runs].tolist())
+    colorFile = open(path, "wb", BUFFER)
+    colorFile.write(scheme.head)
+    colorFile.write("<p>")
+    for k in xrange(0, len(runs), RUNS):
+        colorFile.write(''.join(
+            "</p>\n<p>"*breaks[r]+spans[codes[r]]+
+            ' '.join(text[runs[r]:runEnds[r]])+" </span>"
+            for r in xrange(k, min(k+RUNS, len(runs)))))
+    lastLine = line[-1] if n else 0
+    colorFile.write("</p>\n<p>"*(len(newlines)-lastLine)+"</p>\n")
+    colorFile.write(scheme.tail)
+    colorFile.close()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+# Keeps the scores of metrics applied to a graph on disk, so rerunning a
+#   metric, e.g. to render the heatmap another way, does not compute it
+#   again. Scores are stored as arrays by node position, next to the node
+#   ids, in uncompressed .npz files named by a hash of the fingerprint of
+#   the graph, the remove flag, the metric and its parameters.
+#
+# The cache is bounded by BUDGET bytes: files are touched when they are read,
+#   and the least recently used ones are dropped when a new one is saved.
+
+import hashlib
+import json
+import os
+import numpy as np
+
+
+METRICS = 'metrics'
+BUDGET = 1 << 30
+
+
+
+
+def key(fingerprint, remove, metric, **params):
+    """
+        Returns the key of the scores of metric with params on the graph
+            with fingerprint
+    """
+    return hashlib.sha1(json.dumps([fingerprint, bool(remove), metric, params],
+                                   sort_keys=True)).hexdigest()
+
+
+
+
+def cachePath(key):
+    return METRICS+'/'+key+'.npz'
+
+
+
+
+def load(key):
+    """
+        Returns the node ids and scores saved under key, or None
+    """
+    path = cachePath(key)
+    if not os.path.isfile(path):
+        return None
+    os.utime(path, None)
+    with np.load(path) as arrays:
+        return arrays['nodeIds'], arrays['scores']
+
+
+
+
+def save(key, nodeIds, scores, budget=BUDGET):
+    """
+        Saves the scores by node position of a metric under key, then drops
+            the least recently used scores past budget bytes
+    """
+    if not os.path.isdir(METRICS):
+        os.mkdir(METRICS)
+
+    path = cachePath(key)
+    tmp = path+'.tmp'
+    cacheFile = open(tmp, "wb")
+    np.savez(cacheFile, nodeIds=np.asarray(nodeIds, dtype=np.int64),
+             scores=np.asarray(scores, dtype=np.float64))
+    cacheFile.close()
+    os.rename(tmp, path)
+    _evict(budget, path)
+
+
+
+
+def _evict(budget, keep):
+    """
+        Removes the least recently used files of the cache, except keep,
+            until it takes at most budget bytes
+    """
+    files = []
+    for name in os.listdir(METRICS):
+        path = METRICS+'/'+name
+        if name.endswith('.npz'):
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for (mtime, size, path) in files)
+    for (mtime, size, path) in sorted(files):
+        if total <= budget:
+            break
+        if path != keep:
+            os.remove(path)
+            total -= size
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+# Keeps everything an application of the model produces for a page in one
+#   binary file: the CSR arrays of the graph, the spans of the PatchModel, and
+#   the latest content with the offsets of its words. Arrays are read back by
+#   mapping the file, so nothing is parsed when a cached model is opened.
+#
+# Layout: MAGIC, then the format version and the length of a JSON header as
+#   little-endian uint32s, then the header, then every array at an 8 byte
+#   aligned offset. The header lists the arrays as name: [dtype, offset,
+#   length] and holds the model state and the graph fingerprint.
+
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+from csrGraph import CSRGraph
+
+
+BUNDLES = 'bundles'
+MAGIC = 'WIKIHIST'
+VERSION = 1
+PREFIX = struct.Struct('<II')
+
+# Bytes at which the model splits words, as str.split does
+_SPACE = np.zeros(256, dtype=bool)
+_SPACE[[9, 10, 11, 12, 13, 32]] = True
+
+
+
+
+def bundlePath(title, remove):
+    """
+        Returns the path of the bundle of Wikipedia page, title
+    """
+    if remove:
+        return BUNDLES+'/'+title.replace(" ", "_")+'_rem.bin'
+    return BUNDLES+'/'+title.replace(" ", "_")+'.bin'
+
+
+
+
+def exists(title, remove):
+    return os.path.isfile(bundlePath(title, remove))
+
+
+
+
+def fingerprint(graph):
+    """
+        Returns a hex digest of the nodes and edges of a CSRGraph
+    """
+    digest = hashlib.sha1()
+    for data in (graph.nodeIds, graph.indptr, graph.indices, graph.time,
+                 graph.size, graph.prob, graph.dist):
+        digest.update(np.ascontiguousarray(data).tostring())
+    return digest.hexdigest()
+
+
+
+
+def wordOffsets(content):
+    """
+        Returns the start and end byte offsets of the words of content, a
+            UTF-8 encoded string
+    """
+    word = ~_SPACE[np.frombuffer(content, dtype=np.uint8)]
+    edges = np.diff(np.r_[0, word.astype(np.int8), 0])
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+
+
+def write(title, remove, graph, spans, content, state):
+    """
+        Writes the bundle of Wikipedia page, title: graph is a CSRGraph,
+            spans the (end, pid) spans of the PatchModel, content the UTF-8
+            encoded latest content and state the number of revisions seen,
+            the index of the last revision applied and the next Patch ID.
+    """
+    if not os.path.isdir(BUNDLES):
+        os.mkdir(BUNDLES)
+
+    spans = np.array(list(spans), dtype=np.int64).reshape(-1, 2)
+    (starts, ends) = wordOffsets(content)
+    arrays = [('nodeIds', graph.nodeIds.astype(np.int64)),
+              ('indptr', graph.indptr.astype(np.int64)),
+              ('indices', graph.indices.astype(np.int64)),
+              ('time', graph.time.astype(np.int64)),
+              ('size', graph.size.astype(np.int32)),
+              ('prob', graph.prob.astype(np.float32)),
+              ('dist', graph.dist.astype(np.float32)),
+              ('spanEnds', spans[:, 0].copy()),
+              ('spanPids', spans[:, 1].copy()),
+              ('content', np.frombuffer(content, dtype=np.uint8)),
+              ('wordStarts', starts.astype(np.int64)),
+              ('wordEnds', ends.astype(np.int64))]
+
+    # Offsets are relative to the end of the header, so it can be sized first
+    sections = {}
+    offset = 0
+    for (name, data) in arrays:
+        sections[name] = [data.dtype.str, offset, len(data)]
+        offset += _align(data.nbytes)
+    (revisions, last, pid) = state
+    header = json.dumps({'arrays': sections, 'fingerprint': fingerprint(graph),
+                         'revisions': revisions, 'last': last, 'pid': pid},
+                        sort_keys=True)
+    header += ' '*(_align(len(MAGIC)+PREFIX.size+len(header)) -
+                   (len(MAGIC)+PREFIX.size+len(header)))
+
+    path = bundlePath(title, remove)
+    tmp = path+'.tmp'
+    bundleFile = open(tmp, "wb")
+    bundleFile.write(MAGIC)
+    bundleFile.write(PREFIX.pack(VERSION, len(header)))
+    bundleFile.write(header)
+    for (name, data) in arrays:
+        bundleFile.write(data.tostring())
+        bundleFile.write('\0'*(_align(data.nbytes)-data.nbytes))
+    bundleFile.close()
+    os.rename(tmp, path)
+
+
+
+
+def _align(n):
+    return (n+7)//8*8
+
+
+
+
+class Bundle(object):
+    """
+        A bundle mapped read-only. Arrays are views of the file.
+    """
+
+    def __init__(self, title, remove):
+        path = bundlePath(title, remove)
+        assert os.path.isfile(path), "Bundle does not exist."
+
+        bundleFile = open(path, "rb")
+        prefix = bundleFile.read(len(MAGIC)+PREFIX.size)
+        assert prefix[:len(MAGIC)] == MAGIC, "Not a bundle: "+path
+        (version, length) = PREFIX.unpack(prefix[len(MAGIC):])
+        assert version == VERSION, "Bundle version %d is not supported." % version
+        header = json.loads(bundleFile.read(length))
+        bundleFile.close()
+
+        base = len(MAGIC)+PREFIX.size+length
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        self.arrays = {}
+        for (name, (dtype, offset, count)) in header['arrays'].items():
+            dtype = np.dtype(str(dtype))
+            start = base+offset
+            self.arrays[name] = \
+                self.data[start:start+count*dtype.itemsize].view(dtype)
+
+        self.fingerprint = str(header['fingerprint'])
+        self.state = (header['revisions'], header['last'], header['pid'])
+
+    def graph(self):
+        """
+            Returns the CSRGraph, over the mapped arrays
+        """
+        a = self.arrays
+        return CSRGraph(a['nodeIds'], a['indptr'], a['indices'], a['time'],
+                        a['size'], a['prob'], a['dist'])
+
+    def spans(self):
+        """
+            Returns the ends and the Patch IDs of the spans of the PatchModel
+        """
+        return self.arrays['spanEnds'], self.arrays['spanPids']
+
+    def content(self):
+        """
+            Returns the latest content, UTF-8 encoded
+        """
+        return self.arrays['content'].tostring()
+
+    def words(self):
+        """
+            Returns the start and end byte offsets of the words of content
+        """
+        return self.arrays['wordStarts'], self.arrays['wordEnds']
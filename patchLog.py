@@ -0,0 +1,258 @@
+#!/usr/bin/python
+
+# Keeps the Patches an application of the model made, and checkpoints of its
+#   spans, so the ownership of the text at any revision can be found without
+#   applying the model to the whole history again.
+#
+# The log holds every Patch as its revision, type, start and end; Patch IDs
+#   follow in order from the first one. A checkpoint is taken every
+#   CHECKPOINT_REVISIONS revisions with Patches, or sooner after
+#   CHECKPOINT_PATCHES Patches, so finding the spans at a revision replays a
+#   bounded number of Patches from the checkpoint before it.
+#
+# Versions replays the whole log once instead, keeping the spans after every
+#   revision as snapshots of a persistent SpanTree that share their nodes.
+#
+# The arrays of a log are kept as .npy files in a folder and mapped when it
+#   is read, so a query only touches a checkpoint and the Patches after it.
+
+import bisect
+import os
+import shutil
+import numpy as np
+from array import array
+import revisionStore
+import timestamp as ts
+from Patch import Patch, PatchModel
+
+
+PATCHLOGS = 'patchlogs'
+CHECKPOINT_REVISIONS = 100
+CHECKPOINT_PATCHES = 1 << 14
+ARRAYS = ('revs', 'types', 'starts', 'ends', 'cpRevs', 'cpPatches', 'cpOffsets',
+          'cpEnds', 'cpPids')
+
+
+
+
+def logPath(title, remove):
+    """
+        Returns the folder of the patch log of Wikipedia page, title
+    """
+    if remove:
+        return PATCHLOGS+'/'+title.replace(" ", "_")+'_rem'
+    return PATCHLOGS+'/'+title.replace(" ", "_")
+
+
+
+
+class PatchLog(object):
+    """
+        The Patches applied to a PatchModel from revision rev on, with
+            checkpoints of its spans. The log starts with a checkpoint of
+            spans, the spans after revision rev, and pid, the next Patch ID.
+        A log that was loaded without writable holds mapped read-only
+            arrays, and can be queried but not added to.
+    """
+
+    def __init__(self, pid, rev, spans=()):
+        self.pid = pid   # ID of the first Patch of the log
+        self.revs = array('l')
+        self.types = array('b')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.cpRevs = array('l')
+        self.cpPatches = array('l')   # Patches of the log before each checkpoint
+        self.cpOffsets = array('l', [0])   # Checkpoint spans in cpEnds and cpPids
+        self.cpEnds = array('l')
+        self.cpPids = array('l')
+        self.pending = 0   # Revisions logged since the last checkpoint
+        self.checkpoint(rev, spans)
+
+    def __len__(self):
+        return len(self.revs)
+
+    def nextPid(self):
+        return self.pid+len(self)
+
+    def add(self, rev, patches, spans):
+        """
+            Logs the patches of revision rev, as (type, start, end), once they
+                have been applied, and checkpoints spans, the spans after them,
+                when it is due
+        """
+        if not patches:
+            return
+        for (ptype, start, end) in patches:
+            self.revs.append(rev)
+            self.types.append(ptype)
+            self.starts.append(start)
+            self.ends.append(end)
+        self.pending += 1
+        if self.pending >= CHECKPOINT_REVISIONS or \
+                len(self)-self.cpPatches[-1] >= CHECKPOINT_PATCHES:
+            self.checkpoint(rev, spans)
+
+    def checkpoint(self, rev, spans):
+        """
+            Saves spans, the (end, pid) spans after revision rev
+        """
+        for (end, pid) in spans:
+            self.cpEnds.append(end)
+            self.cpPids.append(pid)
+        self.cpRevs.append(rev)
+        self.cpPatches.append(len(self))
+        self.cpOffsets.append(len(self.cpEnds))
+        self.pending = 0
+
+    def spans(self, rev):
+        """
+            Returns the (end, pid) spans after revision rev, from the last
+                checkpoint at or before it
+        """
+        k = bisect.bisect_right(self.cpRevs, rev)-1
+        assert k >= 0, "The patch log starts after revision %d." % rev
+        (lo, hi) = (int(self.cpOffsets[k]), int(self.cpOffsets[k+1]))
+        model = PatchModel(zip(self.cpEnds[lo:hi].tolist(),
+                               self.cpPids[lo:hi].tolist()))
+        (first, last) = (int(self.cpPatches[k]),
+                         bisect.bisect_right(self.revs, rev))
+        patches = zip(self.types[first:last].tolist(),
+                      self.starts[first:last].tolist(),
+                      self.ends[first:last].tolist())
+        for (i, (ptype, start, end)) in enumerate(patches):
+            model.apply_spans(Patch(self.pid+first+i, ptype, start, end))
+        return list(model.model)
+
+    def versions(self):
+        """
+            Returns the revisions of the first checkpoint and of every
+                revision with Patches after it, and a SpanTree of the spans
+                after each. The trees are snapshots of one persistent tree,
+                so they share all the nodes the Patches between them left.
+        """
+        (lo, hi) = (int(self.cpOffsets[0]), int(self.cpOffsets[1]))
+        model = PatchModel(zip(self.cpEnds[lo:hi].tolist(),
+                               self.cpPids[lo:hi].tolist()), persistent=True)
+        revs = [int(self.cpRevs[0])]
+        trees = [model.model.snapshot()]
+        logRevs = self.revs.tolist()
+        patches = zip(self.types.tolist(), self.starts.tolist(),
+                      self.ends.tolist())
+        for (i, (ptype, start, end)) in enumerate(patches):
+            model.apply_spans(Patch(self.pid+i, ptype, start, end))
+            if i+1 == len(logRevs) or logRevs[i+1] != logRevs[i]:
+                revs.append(logRevs[i])
+                trees.append(model.model.snapshot())
+        return revs, trees
+
+
+
+
+def save(title, remove, log):
+    """
+        Writes the patch log of Wikipedia page, title, as a folder of .npy
+            files, replacing the old one at once
+    """
+    path = logPath(title, remove)
+    tmp = path+'.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    np.save(tmp+'/pid.npy', np.array([log.pid], dtype=np.int64))
+    for name in ARRAYS:
+        np.save(tmp+'/'+name+'.npy', np.array(getattr(log, name), dtype=np.int64))
+    if os.path.isdir(path):
+        os.rename(path, path+'.old')
+    os.rename(tmp, path)
+    if os.path.isdir(path+'.old'):
+        shutil.rmtree(path+'.old')
+
+
+
+
+def load(title, remove, writable=False):
+    """
+        Returns the patch log of Wikipedia page, title, or None. Its arrays
+            are mapped read-only, unless writable, when they are read into
+            memory so Patches can be added.
+    """
+    path = logPath(title, remove)
+    if not os.path.isfile(path+'/pid.npy'):
+        return None
+    log = PatchLog.__new__(PatchLog)
+    log.pid = int(np.load(path+'/pid.npy')[0])
+    for name in ARRAYS:
+        values = np.load(path+'/'+name+'.npy', mmap_mode='r')
+        if writable:
+            values = array('b' if name == 'types' else 'l', values.tolist())
+        setattr(log, name, values)
+    log.pending = len(set(log.revs[log.cpPatches[-1]:])) if writable else 0
+    return log
+
+
+
+
+def revisionAt(meta, revision):
+    """
+        Returns the index in meta, the metadata of a RevisionStore, of
+            revision: a revision ID, or the latest revision at a time given
+            as a Wikipedia timestamp or a month-day-year date. -1 is before
+            the first.
+    """
+    if isinstance(revision, (int, long)):
+        found = np.flatnonzero(meta['rvid'] == revision)
+        assert len(found), "No revision %d." % revision
+        return int(found[0])
+    if 'T' not in revision:
+        revision = ts.minute2ts(ts.string2minute(revision))
+    # Timestamps are not always in the order of the revisions
+    found = np.flatnonzero(meta['timestamp'] <= revision)
+    return int(found[-1]) if len(found) else -1
+
+
+
+
+def ownershipAt(title, remove, revision):
+    """
+        Returns the spans of the PatchModel of Wikipedia page, title, as
+            (end, pid), right after revision (see revisionAt), from its patch
+            log.
+        Revisions the model left out, such as bot reverts with remove, own
+            nothing: the spans are those of the last one applied before.
+    """
+    title = title.replace(" ", "_")
+    log = load(title, remove)
+    assert log is not None, "No patch log for "+title+", apply the model again."
+    rev = revisionAt(revisionStore.readMeta(title), revision)
+    return log.spans(rev)
+
+
+
+
+class Versions(object):
+    """
+        Every version of the spans of the PatchModel of Wikipedia page,
+            title, one per revision with Patches, replayed once from its
+            patch log into snapshots of a persistent SpanTree.
+    """
+
+    def __init__(self, title, remove):
+        title = title.replace(" ", "_")
+        log = load(title, remove)
+        assert log is not None, "No patch log for "+title+", apply the model again."
+        self.meta = revisionStore.readMeta(title)
+        (self.revs, self.trees) = log.versions()
+
+    def __len__(self):
+        return len(self.trees)
+
+    def at(self, revision):
+        """
+            Returns the SpanTree of the spans right after revision (see
+                revisionAt)
+        """
+        rev = revisionAt(self.meta, revision)
+        k = bisect.bisect_right(self.revs, rev)-1
+        assert k >= 0, "The patch log starts after revision %d." % rev
+        return self.trees[k]
@@ -0,0 +1,365 @@
+#!/usr/bin/python
+
+# Parses and cleans the full history of a page once, and keeps the result in
+#   a compact binary store that every later stage reads instead of the XML.
+
+import hashlib
+import os
+import shutil
+import numpy as np
+from array import array
+import textProcessor as proc
+
+
+STORE = 'revisions'
+FORMAT = '2'   # Bumped when the layout of a store changes
+
+# Per-revision metadata
+META = np.dtype([('rvid', np.int64), ('parentid', np.int64),
+                 ('timestamp', 'S20'), ('sha1', 'S32'), ('botrv', np.uint8)])
+
+
+
+
+def storePath(title):
+    """
+        Returns the directory holding the RevisionStore of title
+    """
+    return STORE+'/'+title.replace(" ", "_")
+
+
+
+
+def exists(title):
+    """
+        Returns True if title has already been ingested, in the current
+            format
+    """
+    path=storePath(title)
+    if not os.path.isfile(path+'/meta.npy') or not os.path.isfile(path+'/format'):
+        return False
+    formatFile=open(path+'/format', "r")
+    format=formatFile.read().strip()
+    formatFile.close()
+    return format == FORMAT
+
+
+
+
+def ingest(title):
+    """
+        Parses every revision of title in full_histories once, cleans its
+            markup and writes the text, the token ids and the metadata of
+            all the revisions to revisions/title.
+        The text is split into tokens once, at ASCII whitespace, and each
+            distinct token is interned as an int id. The words the model
+            diffs and the terms of the semantic dictionary are both derived
+            from these ids.
+        A revision with the same content as an earlier one, e.g. a revert,
+            is neither cleaned nor stored again: canon maps it to the first
+            revision with its content.
+    """
+    print "Ingesting revisions . . ."
+
+    path=storePath(title)
+    tmp=path+'.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    open(tmp+'/text.bin', "wb").close()
+    open(tmp+'/tokens.bin', "wb").close()
+
+    vocab={}
+    meta=[]
+    textOffsets=[0]
+    tokenOffsets=[0]
+    canon=[]
+    _append(tmp, proc.iterRevisions(title), vocab, meta, textOffsets,
+            tokenOffsets, canon, {})
+
+    _save(tmp+'/canon.npy', np.array(canon, np.int64))
+    _save(tmp+'/meta.npy', np.array(meta, dtype=META))
+    _save(tmp+'/text_offsets.npy', np.array(textOffsets, np.int64))
+    _save(tmp+'/token_offsets.npy', np.array(tokenOffsets, np.int64))
+    _writeVocab(tmp, vocab, 0)
+    formatFile=open(tmp+'/format', "w")
+    formatFile.write(FORMAT+'\n')
+    formatFile.close()
+
+    # Only expose the store once it is complete
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+
+
+def update(title):
+    """
+        Appends the revisions of title in full_histories that are newer than
+            the last one in its store, i.e. those in the chunks that follow
+            it. Returns the number of revisions added.
+        The metadata is replaced last, so an interrupted update leaves the
+            store as it was.
+    """
+    path=storePath(title)
+    store=RevisionStore(title)
+    if not len(store):
+        ingest(title)
+        return len(RevisionStore(title))
+
+    meta=store.meta.tolist()
+    textOffsets=store.textOffsets.tolist()
+    tokenOffsets=store.tokenOffsets.tolist()
+    canon=store.canon.tolist()
+    hashes=dict((sha1, i) for (i, sha1) in
+                enumerate(store.meta['sha1'].tolist()) if canon[i] == i and sha1)
+    vocab=dict((word, i) for (i, word) in enumerate(store.vocab))
+    known=set(store.meta['rvid'].tolist())
+    last=str(store.meta['timestamp'][-1])
+    del store
+
+    # Drop whatever an interrupted update wrote past the stored revisions
+    _truncate(path+'/text.bin', textOffsets[len(meta)])
+    _truncate(path+'/tokens.bin', 4*tokenOffsets[len(meta)])
+    del textOffsets[len(meta)+1:]
+    del tokenOffsets[len(meta)+1:]
+
+    # Chunks overlap at their boundary timestamp
+    revisions=(rev for rev in proc.iterRevisions(title, last)
+               if int(rev.rvid) not in known)
+    size=len(vocab)
+    added=_append(path, revisions, vocab, meta, textOffsets, tokenOffsets,
+                  canon, hashes)
+    if not added:
+        return 0
+
+    print "Added " + str(added) + " revisions."
+    _writeVocab(path, vocab, size)
+    _save(path+'/text_offsets.npy', np.array(textOffsets, np.int64))
+    _save(path+'/token_offsets.npy', np.array(tokenOffsets, np.int64))
+    _save(path+'/canon.npy', np.array(canon, np.int64))
+    _save(path+'/meta.npy', np.array(meta, dtype=META))
+    return added
+
+
+
+
+def _append(path, revisions, vocab, meta, textOffsets, tokenOffsets, canon,
+            hashes):
+    """
+        Appends the text and tokens of revisions to the store files in path,
+            and their metadata, offsets, canonical revisions and new words to
+            the given lists and vocab. hashes maps the sha1 of every content
+            stored so far to its revision.
+        Returns the number of revisions appended.
+    """
+    textFile=open(path+'/text.bin', "ab")
+    tokenFile=open(path+'/tokens.bin', "ab")
+    added=0
+
+    for rev in revisions:
+        sha1=rev.sha1 or _sha1(rev.text)
+        botrv=rev.comment is not None and "BOT - rv" in rev.comment
+        meta.append((int(rev.rvid), int(rev.parentid or -1), rev.timestamp,
+                     sha1, botrv))
+        added+=1
+
+        # Repeated content takes no space and no cleaning
+        if sha1 in hashes:
+            canon.append(hashes[sha1])
+            textOffsets.append(textOffsets[-1])
+            tokenOffsets.append(tokenOffsets[-1])
+            continue
+        hashes[sha1]=len(canon)
+        canon.append(len(canon))
+
+        content=proc.cleanText(rev.text)
+
+        data=content.encode("utf-8")
+        textFile.write(data)
+        textOffsets.append(textOffsets[-1]+len(data))
+
+        tokens=array('i', [vocab.setdefault(word, len(vocab)) for word
+                           in data.split()])
+        tokens.tofile(tokenFile)
+        tokenOffsets.append(tokenOffsets[-1]+len(tokens))
+
+    textFile.close()
+    tokenFile.close()
+    return added
+
+
+
+
+def _sha1(text):
+    """
+        Returns the sha1 of text in base 36, as in the export, for revisions
+            exported without one
+    """
+    n=int(hashlib.sha1(text.encode("utf-8")).hexdigest(), 16)
+    digits=[]
+    while n:
+        (n, d)=divmod(n, 36)
+        digits.append("0123456789abcdefghijklmnopqrstuvwxyz"[d])
+    return ''.join(reversed(digits)).rjust(31, '0')
+
+
+
+
+def _writeVocab(path, vocab, start):
+    """
+        Appends the words of vocab with ids from start on to vocab.txt
+    """
+    words=sorted((word for word in vocab if vocab[word] >= start),
+                 key=vocab.get)
+    vocabFile=open(path+'/vocab.txt', "a")
+    for word in words:
+        vocabFile.write(word+'\n')
+    vocabFile.close()
+
+
+
+
+def _save(file, data):
+    """
+        Replaces an array file at once, so readers see either the old array
+            or the new one
+    """
+    tmp=file+'.tmp'
+    f=open(tmp, "wb")
+    np.save(f, data)
+    f.close()
+    os.rename(tmp, file)
+
+
+
+
+def _truncate(file, size):
+    """
+        Cuts file down to size bytes
+    """
+    f=open(file, "r+b")
+    f.truncate(size)
+    f.close()
+
+
+
+
+def readMeta(title):
+    """
+        Returns the metadata of the revisions of title, mapped read-only,
+            without opening the rest of its store
+    """
+    path=storePath(title)
+    assert os.path.isfile(path+'/meta.npy'), "Revision store does not exist."
+    return np.load(path+'/meta.npy', mmap_mode='r')
+
+
+
+
+def _mmap(file, dtype):
+    """
+        Maps a raw array file read-only. numpy cannot map empty files.
+    """
+    if os.path.getsize(file) == 0:
+        return np.zeros(0, dtype)
+    return np.memmap(file, dtype=dtype, mode='r')
+
+
+
+
+class RevisionStore(object):
+    """
+        Read access to an ingested history. Revision i is the i-th revision
+            in history order.
+    """
+
+    def __init__(self, title):
+        path=storePath(title)
+        assert os.path.isfile(path+'/meta.npy'), "Revision store does not exist."
+
+        self.title=title
+        self.meta=np.load(path+'/meta.npy')
+        self.textOffsets=np.load(path+'/text_offsets.npy')
+        self.tokenOffsets=np.load(path+'/token_offsets.npy')
+        self.textData=_mmap(path+'/text.bin', np.uint8)
+        self.tokenData=_mmap(path+'/tokens.bin', np.int32)
+
+        self.canon=np.load(path+'/canon.npy')
+
+        # Tokens, UTF-8 encoded, by id
+        vocabFile=open(path+'/vocab.txt', "r")
+        self.vocab=vocabFile.read().split('\n')[:-1]
+        vocabFile.close()
+
+        # The model compares words with non-ASCII characters replaced by ?,
+        #   so tokens that only differ there share a word id
+        self.asciiVocab=[token.decode("utf-8").encode("ascii", "replace")
+                         for token in self.vocab]
+        ids={}
+        self.wordIds=np.array([ids.setdefault(word, len(ids)) for word
+                               in self.asciiVocab], np.int32)
+        self._terms=None
+
+    def __len__(self):
+        return len(self.meta)
+
+    def text(self, i):
+        """
+            Returns the cleaned text of revision i
+        """
+        i=self.canon[i]
+        data=self.textData[self.textOffsets[i]:self.textOffsets[i+1]]
+        return data.tostring().decode("utf-8")
+
+    def texts(self):
+        """
+            Iterates over the cleaned text of every revision
+        """
+        for i in range(len(self)):
+            yield self.text(i)
+
+    def tokens(self, i):
+        """
+            Returns the token ids of revision i
+        """
+        i=self.canon[i]
+        return self.tokenData[self.tokenOffsets[i]:self.tokenOffsets[i+1]]
+
+    def words(self, i):
+        """
+            Returns the words of revision i as the model compares them
+        """
+        vocab=self.asciiVocab
+        return [vocab[t] for t in self.tokens(i).tolist()]
+
+    def ids(self, i):
+        """
+            Returns the words of revision i as ids, equal where the words are
+        """
+        return self.wordIds[self.tokens(i)]
+
+    def terms(self, i):
+        """
+            Returns the lowercased terms of revision i, as the semantic
+                dictionary counts them
+        """
+        if self._terms is None:
+            self._terms=[token.decode("utf-8").lower().split()
+                         for token in self.vocab]
+        terms=self._terms
+        return [term for t in self.tokens(i).tolist() for term in terms[t]]
+
+    def remList(self, start=0):
+        """
+            Returns the ids of revisions that are bot reverts or that were
+                reverted by bots, for the bot reverts from revision start on
+        """
+        remList=[]
+        meta=self.meta[start:]
+        for (rvid, parentid) in meta[['rvid', 'parentid']][
+                meta['botrv'] != 0].tolist():
+            remList.append(rvid)
+            remList.append(parentid)
+        return remList
@@ -1,94 +1,205 @@
 #!/usr/bin/python
 
 import gensim
+import gzip
+import numpy as np
 import os
-import codecs
+import xml.etree.cElementTree as etree
+from collections import namedtuple
+from xml.sax.saxutils import escape
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+Revision = namedtuple('Revision',
+    'rvid parentid timestamp sha1 username comment text')
+
+
+# Compressions of cached history chunks, by the suffix they add
+COMPRESSIONS = [None, 'gz', 'zst']
+
+
+def historyFile(title, offset, compression=None):
+    """
+        Returns the path of the cached history chunk of title that
+            starts at offset, compressed with compression.
+    """
+    path='full_histories/'+title+'/'+title+'|'+offset+'.xml'
+    if compression:
+        path+='.'+compression
+    return path
+
+
+def findHistory(title, offset):
+    """
+        Returns the path of the cached history chunk of title that starts
+            at offset, however it is compressed, or None if there is none.
+    """
+    for compression in COMPRESSIONS:
+        path=historyFile(title, offset, compression)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def openHistory(path):
+    """
+        Opens a cached history chunk for reading, decompressed.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, "rb")
+    if path.endswith('.zst'):
+        assert zstandard is not None, \
+            "Reading "+path+" needs the zstandard package."
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def _chunkOffset(title, name):
+    """
+        Returns the offset of the chunk of title in file name, or None if
+            it is not one
+    """
+    prefix=title+'|'
+    if not name.startswith(prefix):
+        return None
+    for compression in COMPRESSIONS:
+        suffix='.xml'+('.'+compression if compression else '')
+        if name.endswith(suffix):
+            return name[len(prefix):-len(suffix)]
+    return None
+
+
+def _localName(tag):
+    """Strips the export namespace from an element tag"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def iterRevisions(title, offset='0'):
+    """
+        Streams the revisions of title from the cached chunks in
+            full_histories, starting with the chunk at offset and following
+            the chain of chunks named by the last timestamp of the previous one.
+        Yields a Revision per revision with the raw, unfiltered text.
+        Elements are cleared as soon as they are read, so memory is bounded by
+            the size of one revision rather than the size of the chunk.
+    """
+    title=title.replace(" ", "_")
+
+    while findHistory(title, offset) is not None:
+        chunk=openHistory(findHistory(title, offset))
+        start=offset
+        page=None
+
+        for (event, elem) in etree.iterparse(chunk, ('start', 'end')):
+            tag=_localName(elem.tag)
+            if event == 'start':
+                if tag == 'page':
+                    page=elem
+                continue
+            if tag != 'revision':
+                continue
+
+            fields={}
+            for child in elem:
+                name=_localName(child.tag)
+                if name == 'contributor':
+                    for info in child:
+                        if _localName(info.tag) in ('username', 'ip'):
+                            fields['username']=info.text
+                else:
+                    fields[name]=child.text
+
+            offset=fields.get('timestamp')
+            yield Revision(fields.get('id'), fields.get('parentid'), offset,
+                           fields.get('sha1'), fields.get('username'),
+                           fields.get('comment'), fields.get('text') or u"")
+
+            # Drop the revision and anything else the page has accumulated
+            elem.clear()
+            if page is not None:
+                page.clear()
+
+        chunk.close()
+
+        # A chunk without revisions ends the chain
+        if offset == start:
+            break
+
+
+def lastTimestamp(title):
+    """
+        Returns the timestamp of the last cached revision of title, which is
+            the offset its history continues from, or '0' if nothing is
+            cached.
+    """
+    title=title.replace(" ", "_")
+    folder='full_histories/'+title
+    if not os.path.isdir(folder):
+        return '0'
+
+    # Chunks are named by their offset, which sort in history order
+    offsets=[_chunkOffset(title, name) for name in os.listdir(folder)]
+    offsets=[offset for offset in offsets if offset is not None]
+    if not offsets:
+        return '0'
+    offset=max(offsets)
+    for rev in iterRevisions(title, offset):
+        offset=rev.timestamp
+    return offset
+
+
+def cleanText(text):
+    """
+        Strips the wiki markup from the raw text of a revision.
+    """
+    # filter_wiki expects the text still XML-escaped, as it is in the export
+    return gensim.corpora.wikicorpus.filter_wiki(escape(text))
 
 
 class WikiIter(object):
 
     def __iter__(self, title, offset):
+        for rev in iterRevisions(title, offset):
+            yield rev.rvid, rev.timestamp, cleanText(rev.text)
 
-        title=title.replace(" ", "_")
-
-        getid = True # can read id from doc
-        gettime = False # have id ready to use, can read time from doc 
-        gettext= False   # have an id ready to use
-        process = False  # ready to use content
-        writeText= False  # adding to current content
-        
-        while os.path.isfile('full_histories/'+title+'/'+title+'|'+offset+'.xml'):
-            historyFile=codecs.open('full_histories/'+title+'/'+title+'|'+offset+'.xml', "r", "utf-8")
-        
-            line = historyFile.readline().strip()
-            while line[:4] != "<id>":
-                line=historyFile.readline().strip()
-
-            for line in historyFile:
-                line=line.strip()
-
-                # Gets the next revision id
-                if getid:
-                    if line[:4] == "<id>":
-                        rvid = line[4:-5]
-                        getid=False
-                        gettime=True
-
-                # Gets the timestamp of the revision
-                if gettime:
-                    if line[:11] == "<timestamp>":
-                        timestamp = line[11:-12]
-                        offset=timestamp
-                        gettime = False
-                        gettext=True
-
-                # Have an id ready to use, looking for start of content
-                if gettext:
-                    if line[:5] == "<text":
-                        content= ""
-                        line = line.split('">')
-                        if len(line) == 1:
-                            line += [""]
-                        line = line[1]+"\n"
-                        gettext=False
-                        writeText=True
-        
-                # Have reached start if content, looking for end
-                if writeText:
-                    if line[-7:] == "</text>":
-                        content+=line[:-7]
-                        writeText=False
-                        process=True
-                    else:
-                        content+=line+"\n"
-                
-
-                if process:
-                    getid=True
-                    process=False
-                    content = gensim.corpora.wikicorpus.filter_wiki(content)
-                    yield rvid, timestamp, content
-
-        historyFile.close()
 
 class MyCorpus(object):
-    def __init__(self, wikiiter, dictionary):
-        self.wikiiter=wikiiter
+    def __init__(self, docs, dictionary):
+        self.docs=docs
         self.dictionary=dictionary
     def __iter__(self):
-        for (rvid, time, doc) in self.wikiiter:
+        for doc in self.docs:
             yield self.dictionary.doc2bow(doc.split())
 
 
-def saveDictionary(title):
+def historyDocs(title):
+    """
+        Yields the cleaned text of every revision of title, parsed from
+            full_histories
+    """
+    wiki = WikiIter()
+    for (rvid, timestamp, content) in wiki.__iter__(title, "0"):
+        yield content
+
+
+def saveDictionary(title, docs=None, terms=None):
     """
+        Builds the gensim dictionary of title from terms, the lowercased
+            words of each of its revisions, or else from docs, the cleaned
+            text of its revisions. Parses the history if neither is given.
     """
     if not os.path.isdir('dictionaries'):
         os.mkdir('dictionaries')
 
-    wiki = WikiIter()
-    dictionary=gensim.corpora.Dictionary(content.lower().split() 
-            for (rvid, timestamp, content) in wiki.__iter__(title, "0"))
+    if terms is None:
+        if docs is None:
+            docs=historyDocs(title)
+        terms=(content.lower().split() for content in docs)
+    dictionary=gensim.corpora.Dictionary(terms)
     stoplist=set('for a of the and to in'.split())
 
     stop_ids=[dictionary.token2id[stopword] for stopword in stoplist 
@@ -114,15 +225,19 @@ def readDictionary(title):
 
 
 
-def saveCorpus(title, dictionary):
-    """Creates a corpus using the edit history of a page
+def saveCorpus(title, dictionary, docs=None, bows=None):
+    """Creates a corpus using the edit history of a page, from the bags of
+        words of its revisions if given
     """
     if not os.path.isdir('corpus'):
         os.mkdir('corpus')
 
-    wiki = WikiIter()
-
-    corpus=MyCorpus(wiki.__iter__(title, "0"), dictionary)
+    if bows is not None:
+        corpus=bows
+    else:
+        if docs is None:
+            docs=historyDocs(title)
+        corpus=MyCorpus(docs, dictionary)
     file='corpus/' + title.replace(" ", "_")+'.mm'
     gensim.corpora.MmCorpus.serialize(file, corpus)
 
@@ -192,3 +307,118 @@ def scoreDoc(title, index, doc, dictionary, tfidf, lsi):
     sims=index[lsi_doc]
     return(list(enumerate(sims)))
 
+
+
+class TermTable(object):
+    """
+        Maps the token ids of a RevisionStore to the ids of their terms in a
+            dictionary, so bags of words are counted from token ids instead
+            of splitting text again. A token holds several terms if it has
+            non-ASCII whitespace in it, and none if the dictionary dropped
+            them. With lower, terms are lowercased, as in the dictionary.
+    """
+
+    def __init__(self, vocab, dictionary, lower=True):
+        token2id=dictionary.token2id
+        ptr=[0]
+        ids=[]
+        for token in vocab:
+            token=token.decode("utf-8")
+            if lower:
+                token=token.lower()
+            ids.extend(token2id[term] for term in token.split()
+                       if term in token2id)
+            ptr.append(len(ids))
+        self.ptr=np.array(ptr, dtype=np.int64)
+        self.ids=np.array(ids, dtype=np.int64)
+
+    def bow(self, tokens):
+        """
+            Returns the bag of words of a sequence of token ids, as
+                dictionary.doc2bow would
+        """
+        tokens=np.asarray(tokens, dtype=np.int64)
+        starts=self.ptr[tokens]
+        counts=self.ptr[tokens+1]-starts
+        ends=np.cumsum(counts)
+        if not len(ends) or not ends[-1]:
+            return []
+        terms=self.ids[np.repeat(starts-ends+counts, counts)+np.arange(ends[-1])]
+        (terms, counts)=np.unique(terms, return_counts=True)
+        return zip(terms.tolist(), counts.tolist())
+
+
+class LsiDistance(object):
+    """
+        Semantic distance between revisions. Every document is projected
+            through tfidf and lsi in one batch into a matrix of unit vectors,
+            so a distance is 1 minus the dot product of 2 rows.
+        Documents are given as their bags of words, lowercased. revisions,
+            increasing, and rows give the document row of each revision, so
+            revisions with the same content share one; without them
+            revision i is document i.
+        Revision -1 stands for the empty one before the first. An empty
+            document has a zero vector, and so distance 1 to anything.
+    """
+
+    def __init__(self, bows, tfidf, lsi, revisions=None, rows=None):
+        # The number of documents is known from rows, even with none
+        count=None
+        if rows is not None:
+            count=int(np.max(rows))+1 if len(rows) else 0
+        vectors=gensim.matutils.corpus2dense(lsi[tfidf[bows]],
+                                             lsi.num_topics, count).T
+        vectors=np.ascontiguousarray(vectors, dtype=np.float32)
+
+        norms=np.sqrt((vectors*vectors).sum(axis=1))
+        norms[norms == 0]=1
+        vectors/=norms[:, np.newaxis]
+        self.vectors=vectors
+        self.revisions=None
+        if revisions is not None:
+            self.revisions=np.asarray(revisions, dtype=np.int64)
+            self.rowOf=np.asarray(rows, dtype=np.int64)
+        self.zero=np.zeros(vectors.shape[1], dtype=np.float32)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def rows(self, revisions):
+        """
+            Returns the document rows of revisions as an array, -1 for
+                revision -1
+        """
+        revisions=np.asarray(revisions, dtype=np.int64)
+        if self.revisions is None:
+            return np.maximum(revisions, -1)
+        at=np.searchsorted(self.revisions, revisions)
+        known=at < len(self.revisions)
+        known[known]=self.revisions[at[known]] == revisions[known]
+        assert (known | (revisions < 0)).all(), "Revisions were not projected."
+        rows=np.full(len(revisions), -1, dtype=np.int64)
+        rows[known]=self.rowOf[at[known]]
+        return rows
+
+    def vector(self, revision):
+        """
+            Returns the unit lsi vector of revision, by index in the history,
+                the zero vector for revision -1
+        """
+        row=self.rows([revision])[0]
+        if row < 0:
+            return self.zero
+        return self.vectors[row]
+
+    def distances(self, old, new):
+        """
+            Returns the distances between revisions old[k] and new[k] as an
+                array
+        """
+        old=self.rows(old)
+        new=self.rows(new)
+        if not len(self.vectors):
+            return np.ones(len(old))
+        sims=(self.vectors[old]*self.vectors[new]).sum(axis=1)
+        sims[(old < 0) | (new < 0)]=0
+        return 1-sims
+
@@ -1,5 +1,11 @@
+import calendar
+import numpy as np
 from datetime import datetime, timedelta
 
+# in minutes
+MONTH=43200
+YEAR=525600
+
 def time_diff(oldTime, newTime):
     """
         Finds the time difference in minutes between 2 strings 
@@ -27,6 +33,30 @@ def ts2date(ts):
 
     return datetime(year, month, day, hour, minute, second)
 
+def ts2minute(ts):
+    """
+        Minutes since the epoch of a string in Wikipedia timestamp format.
+    """
+    return calendar.timegm(ts2date(ts).timetuple())//60
+
+def minute2ts(minute):
+    """
+        Wikipedia timestamp format of minutes since the epoch.
+    """
+    return datetime.utcfromtimestamp(minute*60).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def ts2minutes(tss):
+    """
+        Array version of ts2minute: minutes since the epoch of an array or
+            list of strings in Wikipedia timestamp format, as int64.
+    """
+    tss=np.asarray(tss)
+    if len(tss) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Drop the trailing Z so numpy parses the rest as ISO 8601
+    seconds=tss.astype('S19').astype('datetime64[s]').astype(np.int64)
+    return seconds//60
+
 def string2date(s):
     """
         month-day-year
@@ -34,3 +64,48 @@ def string2date(s):
     s=s.split('-')
     return datetime(int(s[2]), int(s[0]), int(s[1]), 0, 0, 0)
 
+def date2string(d):
+    """
+        month-day-year of a datetime, as string2date reads it.
+    """
+    return '%d-%d-%d' % (d.month, d.day, d.year)
+
+def dateRange(first, last, days):
+    """
+        month-day-year dates from first up to last, every days days.
+    """
+    assert days>0, "Step must be at least a day."
+    (d, end, step)=(string2date(first), string2date(last), timedelta(days=days))
+    dates=[]
+    while d<=end:
+        dates.append(date2string(d))
+        d+=step
+    return dates
+
+def string2minute(s):
+    """
+        Minutes since the epoch of a month-day-year date.
+    """
+    return calendar.timegm(string2date(s).timetuple())//60
+
+def minute_diff(oldTimes, newTimes):
+    """
+        Array version of time_diff for times in minutes since the epoch.
+    """
+    return np.asarray(newTimes, dtype=np.int64)-np.asarray(oldTimes, dtype=np.int64)
+
+def decay(diff, lowpercent=0.01):
+    """
+        Weights of edits diff minutes old, as an array: 1 for the last month,
+            falling linearly to lowpercent at a year.
+    """
+    diff=np.asarray(diff, dtype=np.float64)
+    s=np.clip(1-(diff-MONTH)/(YEAR-MONTH), lowpercent, 1.0)
+    s[diff<MONTH]=1.0
+    return s
+
+def before(times, cutoff):
+    """
+        Returns a boolean array of which times are before cutoff
+    """
+    return np.asarray(times) < cutoff
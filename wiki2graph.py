@@ -5,106 +5,189 @@
 #    and forming the model/graph
 
 import argparse
+import multiprocessing
 import os
-import requests
-import codecs
+import numpy as np
+import downloader
+import wikiDump
 import textProcessor as proc
+import revisionStore
+import modelBundle
+import patchLog
+import timestamp as ts
 import networkx as nx
-from Patch import PatchSet, PatchModel
+from csrGraph import CSRGraph
+from Patch import Patch, PatchSet, PatchModel, ENGINES, WORD_ENGINES
 
 
-WIKI = 'https://en.wikipedia.org/'
-LIMIT='1000'
+DIFF_CHUNK=16   # Revision pairs handed to a diff worker at a time
 
 
 
 
-def downloadHistory(title):
+def downloadHistory(title, exporter=None):
     """
         Downloads the full history of Wikipedia page, title, into
-            full_histories
+            full_histories, through exporter, a downloader.Exporter
     """
     print "Downloading . . ."
-    offset='0'
-    i=0
-    while offset!='1':
-        print "Starting set " + str(i) + " . . ."
-        i+=1
-        offset=downloadPartial(title, offset)
+    (exporter or downloader.Exporter()).download(title)
 
 
 
 
-def downloadPartial(title, offset):
+def updateHistory(title, exporter=None):
+    """
+        Downloads the revisions of Wikipedia page, title, made since its
+            history was cached, continuing from the last cached revision
+    """
+    print "Downloading new revisions . . ."
+    (exporter or downloader.Exporter()).download(title, proc.lastTimestamp(title))
+
+
+
+
+def downloadPartial(title, offset, exporter=None):
     """
         Downloads up to 1000 revisions of a Wikipedia page, title
             starting at offset.
         Offset '0' gets the first revision.
     """
-    title=title.replace(' ', '_')
-    api = WIKI+ 'w/index.php?title=Special:Export&pages=' + title + \
-                '&offset='+offset+'&limit='+LIMIT+'&action=submit'
-
-    # Set up folder for the new history, if needed
-    if not os.path.isdir('full_histories'):
-        os.mkdir('full_histories')
-    if not os.path.isdir('full_histories/'+title):
-        os.mkdir('full_histories/'+title)
-    
-    cachefile = 'full_histories/'+ title+'/'+title+'|'+offset+'.xml'
-    file=open(cachefile, "w")
-    
-    # Download and save history
-    r=requests.post(api, data="")
-    last=True
-    text=r.text.split('\n')
-    file=codecs.open(cachefile, "w", "utf-8")
-    for line in text:
-        if last:
-            if line.strip()=='<page>':
-                last=False
-        else:
-            if line.strip()[:11]=='<timestamp>':
-                date=line.strip(' ')
-                date=date[11:-12]
-        file.write(line+'\n')
-    file.close()
-
-    # Return offset of next revision
-    if last:
-        os.remove(cachefile)
-        return '1'
-    else:
-        return date
+    return (exporter or downloader.Exporter()).exportChunk(title, offset)
 
 
 
-def applyModel(title, remove):
+def applyModel(title, remove, engine='matcher', jobs=1, model=None):
     """
         Applies PatchModel to the history for Wikipedia page, title.
         Returns the full history tranformed into a graph according to the model,
             the PatchModel, and the most recent content.
+        engine names the diff engine used to compare revisions, and jobs
+            the number of processes that compare them.
+        model is a PatchModel to reset and reuse instead of a new one.
     """
 
     title=title.replace(" ", "_")
 
-    # Make folders for model, graph, and content files
-    if not os.path.isdir('GMLs'):
-        os.mkdir('GMLs')
-    if not os.path.isdir('models'):
-        os.mkdir('models')
-    if not os.path.isdir('content'):
-        os.mkdir('content')
+    # Parse and clean the history once
+    if not revisionStore.exists(title):
+        revisionStore.ingest(title)
+    else:
+        revisionStore.update(title)
+    store=revisionStore.RevisionStore(title)
+
+    print "Setting up distance comparison . . ."
+    (dictionary, tfidf, lsi) = semanticModels(title, store)
+
+    # Get the list of revisions to keep
+    kept = keptRevisions(store, remove)
+
+    # Get the semantic distance of each revision to the one it follows
+    distance = lsiDistance(store, kept, dictionary, tfidf, lsi)
+    dists = revisionDistances(distance, -1, kept)
+       
+
+    print "Applying model . . ."
+
+    if model is None:
+        model = PatchModel()
+    else:
+        model.reset()
+    log = patchLog.PatchLog(0, -1)
+    pid = applyRevisions(model, store, kept, dists, 0, -1, engine, jobs, log)
+
+    last = kept[-1] if kept else -1
+    text = store.text(last) if kept else u""
+    content = text.encode("ascii", "replace")
+
+    graph = model.graph.build()
+    modelBundle.write(title, remove, graph, model.model, text.encode("utf-8"),
+                      (len(store), last, pid))
+    patchLog.save(title, remove, log)
+    
+    return graph, content, list(model.model)
+
+
+
+
+def updateModel(title, remove, engine='matcher', jobs=1):
+    """
+        Applies PatchModel to the revisions of Wikipedia page, title, that are
+            newer than the cached graph, model and content, and extends them.
+        The dictionary, tfidf and lsi models of the first application are
+            reused, so new distances can differ slightly from those of
+            applyModel.
+        Falls back to applyModel if there is no saved state to resume from,
+            or if a new bot revert undoes an applied revision.
+    """
+    title=title.replace(" ", "_")
+    state=readState(title, remove)
+    if state is None or not revisionStore.exists(title):
+        return applyModel(title, remove, engine, jobs)
+    (seen, last, pid) = state
+
+    revisionStore.update(title)
+    store=revisionStore.RevisionStore(title)
+    if seen == len(store):
+        print "No new revisions."
+        return readGraph(title, remove), readContent(title, remove), \
+            readModel(title, remove)
+
+    if remove:
+        applied = set(store.meta['rvid'][:seen].tolist())
+        if applied.intersection(store.remList(seen)):
+            print "New bot revert of an applied revision."
+            return applyModel(title, remove, engine, jobs)
 
     print "Setting up distance comparison . . ."
+    (dictionary, tfidf, lsi) = semanticModels(title, store)
+    kept = keptRevisions(store, remove, seen)
 
-    # Set up semantic distance comparison
+    # Only the new revisions and the one they follow are projected
+    distance = lsiDistance(store, [last]+kept, dictionary, tfidf, lsi)
+    dists = revisionDistances(distance, last, kept)
+
+    print "Applying model . . ."
+
+    model = PatchModel(readModel(title, remove), readGraph(title, remove))
+    # A log from before patch logs, or out of step, starts again from here
+    log = patchLog.load(title, remove, True)
+    if log is None or log.nextPid() != pid:
+        log = patchLog.PatchLog(pid, last, model.model)
+    pid = applyRevisions(model, store, kept, dists, pid, last, engine, jobs,
+                         log)
+
+    if kept:
+        last = kept[-1]
+    text = store.text(last) if last >= 0 else u""
+    content = text.encode("ascii", "replace")
+
+    graph = model.graph.build()
+    modelBundle.write(title, remove, graph, model.model, text.encode("utf-8"),
+                      (len(store), last, pid))
+    patchLog.save(title, remove, log)
+
+    return graph, content, list(model.model)
+
+
+
+
+def semanticModels(title, store):
+    """
+        Returns the dictionary, tfidf and lsi models of Wikipedia page, title,
+            building and saving any that are not cached from the tokens of
+            store.
+    """
     if not os.path.isdir("dictionaries") or not os.path.isfile('dictionaries/'+title+'.dict'):
-        proc.saveDictionary(title)
+        proc.saveDictionary(title, terms=(store.terms(i)
+                                          for i in xrange(len(store))))
     dictionary=proc.readDictionary(title)
     
     if not os.path.isdir("corpus") or not os.path.isfile('corpus/'+title+'.mm'):
-        proc.saveCorpus(title, dictionary)
+        # The corpus has always counted words with their case kept
+        table=proc.TermTable(store.vocab, dictionary, lower=False)
+        proc.saveCorpus(title, dictionary, bows=(table.bow(store.tokens(i))
+                                                 for i in xrange(len(store))))
     corpus=proc.readCorpus(title)
     
     if not os.path.isdir("tfidf") or not os.path.isfile('tfidf/'+title+'.tfidf'):
@@ -115,118 +198,194 @@ def applyModel(title, remove):
         proc.saveLsi(title, tfidf, corpus, dictionary, 300)
     lsi=proc.loadLsi(title)
 
+    return dictionary, tfidf, lsi
 
-    # Get the list of vertices to remove
-    if remove:
-        remList = getRemlist(title)
-       
 
-    print "Applying model . . ."
 
-    model = PatchModel()
-    prev = ""
-    pid=0
-    offset='0'
-    wikiit=proc.WikiIter()
-    
-    for (rvid, timestamp, content) in wikiit.__iter__(title, offset):
-       
-        # Apply to the PatchModel and write dependencies to graph.
-        if remove and rvid in remList:
-            remList.remove(rvid)
-    
-        else:
-            # Get semantic distance
-            dist = 1-proc.scoreDoc(title, prev, content, dictionary, tfidf, lsi)[0][1]
-            
-            # Apply PatchModel
-            content=content.encode("ascii", "replace")
-            contentList=content.split()
-            prevList=prev.split()
-            ps = PatchSet.psdiff(pid, prevList, contentList)
-            pid+=len(ps.patches)
-            for p in ps.patches:
-                model.apply_patch(p, timestamp, dist) #list of out-edges from rev
-            
-            prev = content
-        
-        
-    if remove:
-        cachefile = title.replace(" ", "_")+'_rem.txt'
-    else:
-        cachefile = title.replace(" ", "_")+'.txt'
-
-    # Writes graph to file
-    nx.write_gml(model.graph, "GMLs/"+cachefile)
-        
-    # Write model to file
-    modelFile = open("models/"+ cachefile, "w")
-    line = ""
-    for patch in model.model:
-        line+= str(patch[0])+' '+str(patch[1])+'\n'
-    modelFile.write(line)
-    modelFile.close()
 
-    # Write content to file
-    contentFile = open("content/"+ cachefile, "w")
-    contentFile.write(content)
-    contentFile.close()
-    
-    return model.graph, content, model.model
+def keptRevisions(store, remove, start=0):
+    """
+        Returns the indices of the revisions of store from start on that the
+            model is applied to. With remove, bot reverts and the revisions
+            they revert are left out.
+    """
+    remList = set(store.remList()) if remove else set()
+    rvids = store.meta['rvid'][start:].tolist()
+    return [start+k for (k, rvid) in enumerate(rvids) if rvid not in remList]
 
 
 
 
-def getRemlist(title):
+def applyRevisions(model, store, kept, dists, pid, prev, engine, jobs=1,
+                   log=None):
     """
-        Gets a list of ids of revisions that are bot reverts
-        or that were reverted by bots
+        Applies the revisions kept of store, at distances dists from the ones
+            they follow, to model. prev is the index of the revision applied
+            before them (-1 for none) and pid the next Patch ID.
+        The Patches of each revision are added to log, a patchLog.PatchLog,
+            if there is one.
+        With more than 1 job, a pool of processes diffs the pairs of
+            revisions while the Patches are applied in order here.
+        Returns the next Patch ID.
     """
-    print "Removing bot rv."
-    offset='0'
-    remList = []
-    title=title.replace(" ", "_")
-    
-    while os.path.isfile('full_histories/'+title+'/'+title+'|'+offset+'.xml'):
-        
-        file = codecs.open('full_histories/'+title+'/'+title+'|'+offset+'.xml', "r", "utf-8")
-        
-        username=False
-    
-        for line in file:
-            line=line.strip()
+    minutes = ts.ts2minutes(store.meta['timestamp']).tolist()
+
+    # Diff each pair of contents once. Edit wars repeat the same pairs, and
+    #   a revision the same as the one before it has no Patches.
+    canon = store.canon.tolist()
+    pairs = [(canon[old] if old >= 0 else -1, canon[new])
+             for (old, new) in zip([prev]+kept[:-1], kept)]
+    uses = {}
+    for pair in pairs:
+        uses[pair] = uses.get(pair, 0) + 1
+    tasks = []
+    for pair in pairs:
+        if pair[0] != pair[1] and uses[pair] > 0:
+            tasks.append(pair + (engine,))
+            uses[pair] = -uses[pair]
+
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs, _openStore, (store.title,))
+        diffs = pool.imap(_diffRevisions, tasks, DIFF_CHUNK)
+    else:
+        diffs = (diffRevisions(store, *task) for task in tasks)
 
-            if not username and line[:4] == "<id>":
-                rvid = line[4:-5]
+    repeats = {}
+    try:
+        for (i, dist, pair) in zip(kept, dists, pairs):
+            if pair[0] == pair[1]:
+                continue
 
-            if line[:10] == "<username>":
-                username=True
+            # Keep the Patches of a pair until its last use
+            if pair in repeats:
+                patches = repeats[pair]
             else:
-                username=False
+                patches = next(diffs)
+            uses[pair] += 1
+            if uses[pair]:
+                repeats[pair] = patches
+            else:
+                repeats.pop(pair, None)
+
+            # Apply to the PatchModel and write dependencies to graph.
+            for (ptype, start, end) in patches:
+                p = Patch(pid, ptype, start, end)
+                pid+=1
+                model.apply_patch(p, minutes[i], dist) #list of out-edges from rev
+            if log is not None:
+                log.add(i, patches, model.model)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return pid
+
+
+
+
+def lsiDistance(store, revisions, dictionary, tfidf, lsi):
+    """
+        Returns an LsiDistance over revisions of store, by index, -1
+            standing for an empty one. Each distinct content is projected
+            once.
+    """
+    revs = np.unique(np.asarray(revisions, dtype=np.int64))
+    revs = revs[revs >= 0]
+    (unique, rows) = np.unique(store.canon[revs], return_inverse=True)
+
+    table = proc.TermTable(store.vocab, dictionary)
+    return proc.LsiDistance((table.bow(store.tokens(i))
+                             for i in unique.tolist()), tfidf, lsi, revs, rows)
+
+
+
+
+def revisionDistances(distance, prev, kept):
+    """
+        Returns the semantic distance of each revision kept to the one
+            before it, the first one following revision prev (-1 for none),
+            from distance, an LsiDistance over them
+    """
+    if not kept:
+        return []
+    return distance.distances([prev]+kept[:-1], kept).tolist()
+
+
+
+
+def diffRevisions(store, old, new, engine):
+    """
+        Compares revision old of store, -1 standing for an empty one, with
+            revision new. Returns the Patches as (type, start, end), to be
+            numbered by the caller.
+    """
+    words = store.words if engine in WORD_ENGINES else store.ids
+    prevList = words(old) if old >= 0 else []
+    ps = PatchSet.psdiff(0, prevList, words(new), engine)
+    return [(p.ptype, p.start, p.end) for p in ps.patches]
+
+
+# The RevisionStore of a diff worker process
+_store = None
+
+def _openStore(title):
+    global _store
+    _store = revisionStore.RevisionStore(title)
+
+def _diffRevisions(task):
+    return diffRevisions(_store, *task)
 
-            if line[:10] == "<parentid>":
-                parentid=line[10:-11]
 
-            elif line[:11]=='<timestamp>':
-                offset=line[11:-12]
 
-            elif line[:9]=="<comment>":
-                if "BOT - rv" in line:
-                    remList.append(rvid)
-                    remList.append(parentid)
 
-        file.close()
-    return remList
+def cacheFile(title, remove):
+    """
+        Returns the name of the graph, model and content files of Wikipedia
+            page, title, as written before bundles
+    """
+    if remove:
+        return title.replace(" ", "_")+'_rem.txt'
+    return title.replace(" ", "_")+'.txt'
+
+
+
+
+def readState(title, remove):
+    """
+        Returns the state saved with the cached model of Wikipedia page,
+            title, as (revisions seen, last revision applied, next Patch ID),
+            or None if there is none.
+    """
+    if not modelBundle.exists(title, remove):
+        return None
+    return modelBundle.Bundle(title, remove).state
+
+
+
+
+def getRemlist(title):
+    """
+        Gets a list of ids of revisions that are bot reverts
+        or that were reverted by bots
+    """
+    print "Removing bot rv."
+    if not revisionStore.exists(title):
+        revisionStore.ingest(title)
+    return revisionStore.RevisionStore(title).remList()
 
 
 
 
 def readGraph(title, remove):
     """
-        Reads a networkx graph from a file for Wikipedia page, title, with
-            remove 
+        Reads the CSRGraph of Wikipedia page, title, with remove, from its
+            bundle, or from a GML file written before bundles.
     """
     print "Reading graph . . ."
+    if modelBundle.exists(title, remove):
+        return modelBundle.Bundle(title, remove).graph()
+
     if remove:
         file = "GMLs/" + title.replace(" ", "_")+'_rem.txt'
     else:
@@ -234,16 +393,20 @@ def readGraph(title, remove):
 
     assert os.path.isfile(file), "Graph file does not exist."
 
-    return nx.read_gml(file)
+    return CSRGraph.fromDiGraph(nx.read_gml(file))
 
 
 
 
 def readContent(title, remove):
     """
-        Reads and returns a string from a file
+        Reads and returns the latest content as a string, with non-ASCII
+            characters replaced, from the bundle or a content file
     """
     print "Reading content . . ."
+    if modelBundle.exists(title, remove):
+        content = modelBundle.Bundle(title, remove).content()
+        return content.decode("utf-8").encode("ascii", "replace")
 
     if remove:
         file = "content/"+title.replace(" ", "_")+"_rem.txt"
@@ -253,9 +416,7 @@ def readContent(title, remove):
     assert os.path.isfile(file), "Content file does not exist."
 
     contentFile = open(file, "r")
-    content = ""
-    for line in contentFile:
-        content+=line
+    content = contentFile.read()
     contentFile.close()
     return content
 
@@ -264,9 +425,14 @@ def readContent(title, remove):
 
 def readModel(title, remove):
     """
-        Reads and returns a PatchModel from a file
+        Reads and returns the spans of a PatchModel, as (end, pid), from
+            the bundle or a model file
     """
     print "Reading model . . ."
+    if modelBundle.exists(title, remove):
+        (ends, pids) = modelBundle.Bundle(title, remove).spans()
+        return zip(ends.tolist(), pids.tolist())
+
     if remove:
         file = "models/"+title.replace(" ", "_")+"_rem.txt"
     else:
@@ -287,36 +453,50 @@ def readModel(title, remove):
 
 
 
-def wiki2graph(title, remove, new):
+def wiki2graph(title, remove, new, engine='matcher', update=False, jobs=1,
+               exporter=None, dump=None):
     """
-        Returns a networkx graph, the content of the latest revision, and the 
+        Returns a CSRGraph, the content of the latest revision, and the 
             PatchModel for Wikipedia page, title.
         Setting remove to True removes bot reverses and vandalism from the data.
         Setting new to True applies the model whether or not it is cached
+        engine names the diff engine used when the model is applied.
+        Setting update to True downloads the revisions made since the history
+            was cached and applies the model to those only.
+        jobs is the number of processes that diff revisions.
+        exporter is the downloader.Exporter that downloads the history.
+        dump is an indexed multistream dump to read the history from
+            instead, if it is not cached.
     """
-    if remove:
-        file = title.replace(" ", "_")+"_rem.txt"
-    else:
-        file = title.replace(" ", "_")+".txt"
+    file = cacheFile(title, remove)
 
 
     # Check if files exist to avoid reapplying model
-    if not new and \
+    if not new and (modelBundle.exists(title, remove) or \
         os.path.isdir('GMLs') and os.path.isfile("GMLs/"+file) and \
         os.path.isdir('content') and os.path.isfile("content/"+file) and \
-        os.path.isdir('models/') and os.path.isfile("models/"+file):
+        os.path.isdir('models/') and os.path.isfile("models/"+file)):
 
-        graph = readGraph(title, remove)
-        content = readContent(title, remove)
-        model = readModel(title, remove)
+        if update:
+            updateHistory(title, exporter)
+            (graph, content, model) = updateModel(title, remove, engine, jobs)
+        else:
+            graph = readGraph(title, remove)
+            content = readContent(title, remove)
+            model = readModel(title, remove)
 
 
 
     # Apply model. Download full history if necessary
     else:
         if not os.path.isdir('full_histories') or not os.path.isdir("full_histories/"+title.replace(' ', '_')):
-            downloadHistory(title)
-        (graph, content, model) = applyModel(title, remove)
+            if dump:
+                wikiDump.extractHistory(dump, title)
+            else:
+                downloadHistory(title, exporter)
+        elif update:
+            updateHistory(title, exporter)
+        (graph, content, model) = applyModel(title, remove, engine, jobs)
 
     return graph, content, model
 
@@ -335,10 +515,35 @@ def parse_args():
     parser.add_argument('-n', '--new',
                       action='store_true', dest='new', default=False,
                       help='reapply model even if cached')
+    parser.add_argument('-d', '--diff',
+                      dest='engine', default='matcher', choices=sorted(ENGINES),
+                      help='diff engine used to compare revisions')
+
+    parser.add_argument('-u', '--update',
+                      action='store_true', dest='update', default=False,
+                      help='download and apply only new revisions')
+
+    parser.add_argument('-j', '--jobs',
+                      type=int, dest='jobs', default=1,
+                      help='number of processes that diff revisions')
+
+    parser.add_argument('-w', '--wiki',
+                      dest='wiki', default=downloader.WIKI,
+                      help='base URL of the wiki to download from')
+
+    parser.add_argument('-z', '--compress',
+                      dest='compression', default=None, choices=['gz', 'zst'],
+                      help='compress the downloaded history')
+
+    parser.add_argument('--dump',
+                      dest='dump', default=None,
+                      help='indexed multistream dump to read the history from')
 
     n=parser.parse_args()
 
-    wiki2graph(n.title[0], n.remove, n.new)
+    exporter=downloader.Exporter(n.wiki, n.compression)
+    wiki2graph(n.title[0], n.remove, n.new, n.engine, n.update, n.jobs,
+               exporter, n.dump)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,410 @@
+#!/usr/bin/python
+
+# Ingests pages from a local Wikipedia dump with full histories, a
+#   pages-meta-history*.xml.bz2 file (multistream or not) or plain .xml.
+#
+# The dump is decompressed and split a line at a time: each page is written
+#   out as a single history chunk in full_histories, just as if it had been
+#   downloaded, and handed to a worker process that applies the model to it
+#   and writes its bundle. Nothing holds more than a block of the dump.
+#
+# A multistream dump can also be indexed once, so that the history of one
+#   page is read by seeking to the streams it is in.
+
+import argparse
+import bisect
+import bz2
+import os
+import multiprocessing
+import sys
+import traceback
+from xml.sax.saxutils import unescape
+import textProcessor as proc
+import wiki2graph as w2g
+from Patch import ENGINES, PatchModel
+
+
+BLOCK = 1 << 20   # Bytes of the dump read at a time
+QUEUED = 2   # Pages waiting per worker before splitting pauses
+INDEX = '.index'   # Suffix of the index of a dump
+
+_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+_model = None   # The PatchModel a worker reuses for each of its pages
+
+
+
+
+class MultiBZ2(object):
+    """
+        Reads a file of one or more concatenated bz2 streams, as multistream
+            dumps are, decompressed. bz2.BZ2File stops after the first.
+        Reading starts at offset, which must be the start of a stream.
+            streams lists the streams seen so far as (decompressed position,
+            compressed offset) pairs, and position is the number of bytes
+            read.
+    """
+
+    def __init__(self, path, offset=0):
+        self.compressed = open(path, "rb")
+        self.compressed.seek(offset)
+        self.decompressor = bz2.BZ2Decompressor()
+        self.position = 0
+        self.streams = [(0, offset)]
+
+    def read(self, size=BLOCK):
+        """
+            Returns the next decompressed data, at least a byte of it unless
+                the file has ended. size is how much compressed data is read
+                at a time.
+        """
+        while True:
+            base = self.compressed.tell()
+            data = self.compressed.read(size)
+            if not data:
+                return ''
+            out = []
+            while data:
+                try:
+                    out.append(self.decompressor.decompress(data))
+                except EOFError:
+                    # The last stream ended with the previous data
+                    self._nextStream(base)
+                    continue
+                self.position += len(out[-1])
+                rest = self.decompressor.unused_data
+                if rest:
+                    base += len(data)-len(rest)
+                    self._nextStream(base)
+                data = rest
+            out = ''.join(out)
+            if out:
+                return out
+
+    def _nextStream(self, offset):
+        self.decompressor = bz2.BZ2Decompressor()
+        self.streams.append((self.position, offset))
+
+    def close(self):
+        self.compressed.close()
+
+
+
+
+def openDump(path):
+    """
+        Opens a dump for reading, decompressed
+    """
+    if path.endswith('.bz2'):
+        return MultiBZ2(path)
+    return open(path, "rb")
+
+
+
+
+def dumpLines(dump):
+    """
+        Yields the lines of an open dump, a block at a time
+    """
+    rest = ''
+    while True:
+        block = dump.read(BLOCK)
+        if not block:
+            break
+        lines = (rest+block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line+'\n'
+    if rest:
+        yield rest
+
+
+
+
+def splitPages(dump, titles=None):
+    """
+        Writes the history of every page of dump, an open dump, to
+            full_histories as one chunk, and yields its title once it is
+            written. With titles, only those pages are kept, and splitting
+            stops once they have all been found.
+    """
+    if titles is not None:
+        titles = set(title.replace('_', ' ') for title in titles)
+    header = '<mediawiki>\n'
+    head = None     # Lines of a page before its title
+    title = None
+    chunk = None
+
+    for line in dumpLines(dump):
+        tag = line.strip()
+        if chunk is not None:
+            chunk.write(line)
+            if tag == '</page>':
+                chunk.write('</mediawiki>\n')
+                chunk.close()
+                os.rename(path+'.tmp', path)
+                chunk = None
+                yield title
+                if titles is not None:
+                    titles.discard(title)
+                    if not titles:
+                        return
+        elif head is not None:
+            head.append(line)
+            if tag.startswith('<title>'):
+                title = unescape(tag[len('<title>'):-len('</title>')], _ENTITIES)
+                if titles is None or title in titles:
+                    path = _chunkPath(title)
+                    chunk = open(path+'.tmp', "wb")
+                    chunk.write(header)
+                    chunk.writelines(head)
+                head = None
+        elif tag == '<page>':
+            head = [line]
+        elif tag.startswith('<mediawiki'):
+            header = line
+
+
+
+
+def buildIndex(path, indexPath=None):
+    """
+        Writes the index of the multistream dump at path, to indexPath or
+            next to the dump: a line per page, sorted by title, of its
+            title, the offset of the bz2 stream it starts in, the bytes
+            of that stream before it, and its length, separated by tabs.
+    """
+    print "Indexing "+path+" . . ."
+    dump = MultiBZ2(path)
+    entries = []
+    position = 0
+    title = None
+    for line in dumpLines(dump):
+        tag = line.strip()
+        if tag == '<page>':
+            # Streams before the one the page starts in are done with
+            k = bisect.bisect_right(dump.streams, (position, sys.maxint))-1
+            (streamPosition, offset) = dump.streams[k]
+            del dump.streams[:k]
+            start = position
+        elif tag.startswith('<title>') and title is None:
+            title = unescape(tag[len('<title>'):-len('</title>')], _ENTITIES)
+        elif tag == '</page>':
+            entries.append((title, offset, start-streamPosition,
+                            position+len(line)-start))
+            title = None
+        position += len(line)
+    dump.close()
+
+    entries.sort()
+    indexPath = indexPath or path+INDEX
+    indexFile = open(indexPath+'.tmp', "wb")
+    for entry in entries:
+        indexFile.write('%s\t%d\t%d\t%d\n' % entry)
+    indexFile.close()
+    os.rename(indexPath+'.tmp', indexPath)
+
+
+
+
+def findPage(path, title, indexPath=None):
+    """
+        Returns the stream offset, the bytes to skip and the length of the
+            page title in the dump at path, from its index, or None if the
+            dump has no such page. The index is searched on disk.
+    """
+    indexPath = indexPath or path+INDEX
+    assert os.path.isfile(indexPath), \
+        "No index for "+path+", build it with wikiDump.py -i."
+    title = title.replace('_', ' ')
+    key = title+'\t'
+    indexFile = open(indexPath, "rb")
+    (lo, hi) = (0, os.path.getsize(indexPath))
+    # The first line starting at or after lo is the one compared
+    while lo < hi:
+        mid = (lo+hi)//2
+        indexFile.seek(mid)
+        if mid:
+            indexFile.readline()
+        line = indexFile.readline()
+        if line and line < key:
+            lo = mid+1
+        else:
+            hi = mid
+    indexFile.seek(lo)
+    if lo:
+        indexFile.readline()
+    line = indexFile.readline()
+    indexFile.close()
+    if not line.startswith(key):
+        return None
+    fields = line.rstrip('\n').split('\t')
+    return int(fields[1]), int(fields[2]), int(fields[3])
+
+
+
+
+def extractHistory(path, title, indexPath=None):
+    """
+        Writes the history of title from the multistream dump at path to
+            full_histories as one chunk, reading only the streams it is in.
+    """
+    print "Reading "+title+" from "+path+" . . ."
+    page = findPage(path, title, indexPath)
+    assert page is not None, title+" is not in "+path+"."
+    (offset, skip, length) = page
+
+    # The root element is in the first stream
+    dump = MultiBZ2(path)
+    header = dump.read(BLOCK).split('\n', 1)[0]+'\n'
+    dump.close()
+
+    chunkPath = _chunkPath(title)
+    chunk = open(chunkPath+'.tmp', "wb")
+    chunk.write(header if header.strip().startswith('<mediawiki') else
+                '<mediawiki>\n')
+    dump = MultiBZ2(path, offset)
+    data = ''
+    while length:
+        while not data:
+            data = dump.read(BLOCK)
+            assert data, path+" ended before "+title+"."
+        if skip:
+            (data, skip) = (data[skip:], max(0, skip-len(data)))
+            continue
+        chunk.write(data[:length])
+        (data, length) = (data[length:], max(0, length-len(data)))
+    dump.close()
+    chunk.write('</mediawiki>\n')
+    chunk.close()
+    os.rename(chunkPath+'.tmp', chunkPath)
+
+
+
+
+def _chunkPath(title):
+    """
+        Returns the path of the chunk the history of title is written to,
+            the first one of its history
+    """
+    title = title.replace(' ', '_')
+    folder = 'full_histories/'+title
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return proc.historyFile(title, '0')
+
+
+
+
+def _startWorker():
+    """
+        Gives a worker the PatchModel it applies to every page it is handed
+    """
+    global _model
+    _model = PatchModel()
+
+
+
+
+def _applyModel(args):
+    """
+        Applies the model to the history of a title in a worker. Returns an
+            error message if it fails, so the other pages go on.
+    """
+    (title, remove, engine) = args
+    try:
+        w2g.applyModel(title, remove, engine, model=_model)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+
+
+def ingestDump(path, titles=None, remove=False, engine='matcher', jobs=1):
+    """
+        Applies the model to every page of the dump at path, or to those in
+            titles, with jobs worker processes, leaving a bundle per page.
+        Workers live for the whole dump, each resetting one PatchModel for
+            every page, so the interpreter and its imports start only once.
+        Returns the titles of the pages that failed.
+    """
+    pool = multiprocessing.Pool(jobs, _startWorker)
+    pending = []
+    failed = []
+    dump = openDump(path)
+    for title in splitPages(dump, titles):
+        pending.append((title, pool.apply_async(_applyModel,
+                                                ((title, remove, engine),))))
+        # Keep the split from running far ahead of the workers
+        while len(pending) >= QUEUED*jobs:
+            _finish(pending.pop(0), failed)
+    dump.close()
+    for page in pending:
+        _finish(page, failed)
+    pool.close()
+    pool.join()
+    return failed
+
+
+
+
+def _finish(page, failed):
+    """
+        Waits for the worker on page, a title and its result, and adds the
+            title to failed if it failed
+    """
+    (title, result) = page
+    error = result.get()
+    if error is None:
+        print "Applied model to "+title+"."
+    else:
+        print "Failed to apply model to "+title+":\n"+error
+        failed.append(title)
+
+
+
+
+def readTitles(path):
+    """
+        Returns the titles listed in the file at path, one per line
+    """
+    titleFile = open(path, "r")
+    titles = [line.strip() for line in titleFile if line.strip()]
+    titleFile.close()
+    return titles
+
+
+
+
+def parse_args():
+    """parse_args parses sys.argv for wikiDump."""
+    parser = argparse.ArgumentParser(usage='%(prog)s [options] dump')
+    parser.add_argument('dump', nargs=1)
+    parser.add_argument('-t', '--titles',
+                      dest='titles', default=None,
+                      help='file of the titles to ingest, one per line')
+    parser.add_argument('-r', '--remove',
+                      action='store_true', dest='remove', default=False,
+                      help='remove mass deletions')
+    parser.add_argument('-d', '--diff',
+                      dest='engine', default='matcher', choices=sorted(ENGINES),
+                      help='diff engine used to compare revisions')
+    parser.add_argument('-j', '--jobs',
+                      type=int, dest='jobs', default=multiprocessing.cpu_count(),
+                      help='number of pages processed at once')
+    parser.add_argument('-i', '--index',
+                      action='store_true', dest='index', default=False,
+                      help='only build the index of a multistream dump')
+
+    n=parser.parse_args()
+
+    if n.index:
+        buildIndex(n.dump[0])
+        return
+    titles = readTitles(n.titles) if n.titles else None
+    ingestDump(n.dump[0], titles, n.remove, n.engine, n.jobs)
+
+
+if __name__ == '__main__':
+    parse_args()